@@ -1,27 +1,71 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-import uvicorn
+from fastapi.responses import PlainTextResponse, StreamingResponse
 import sys
 import io
 import os
+import asyncio
+import traceback
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+import contextvars
 import re
 import time
-import random
-import requests
-import pandas as pd
+import sqlite3
+import hashlib
+import json
+import threading
+import itertools
+import zipfile
+import importlib
+from collections import OrderedDict
+import httpx
 from datetime import datetime, timedelta
-from urllib.parse import unquote
-import gdown
-from bs4 import BeautifulSoup
-import yfinance as yf
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
+from urllib.parse import unquote, urlparse
+from concurrent.futures import ThreadPoolExecutor
+
+class LazyModule:
+    """Stands in for a module and imports it on first attribute access.
+
+    pandas, numpy, yfinance, bs4 and openpyxl make up most of the import time
+    and memory of this module, and none of them is needed to start serving.
+    Setting an attribute on the proxy shadows the module's (handy for tests).
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+np = LazyModule("numpy")
+pd = LazyModule("pandas")
+yf = LazyModule("yfinance")
+bs4 = LazyModule("bs4")
+openpyxl = LazyModule("openpyxl")
+pyarrow = LazyModule("pyarrow")
+parquet = LazyModule("pyarrow.parquet")
 
 # Fix Windows console encoding
 sys.stdout.reconfigure(encoding='utf-8')
 sys.stderr.reconfigure(encoding='utf-8')
 
-app = FastAPI()
+STARTED_AT = time.monotonic()
+
+@asynccontextmanager
+async def lifespan(app):
+    scheduler.start()
+    yield
+    await scheduler.stop()
+    if processor is not None:
+        await processor.http.aclose()
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -33,142 +77,1502 @@ app.add_middleware(
 
 # Cache directory
 CACHE_DIR = "etf_data_cache"
+# Downloaded workbooks, one file per Drive file id, listed in FILES_DIR/index.json
+FILES_DIR = os.path.join(CACHE_DIR, "files")
+# Newest dated files per ETF that are never evicted, and the byte budget for everything else
+CACHE_KEEP_PER_ETF = int(os.environ.get("CACHE_KEEP_PER_ETF", 5))
+CACHE_MAX_BYTES = int(os.environ.get("CACHE_MAX_BYTES", 512 * 1024 * 1024))
+# Holdings parsed out of the downloaded workbooks, one Parquet file per source file
+PARSED_DIR = os.path.join(CACHE_DIR, "parsed")
+# Per-folder Drive listings with HTTP validators, used for incremental syncs
+MANIFEST_DIR = os.path.join(CACHE_DIR, "manifests")
+# Daily holdings of every dated file ever seen; never evicted by cleanup_cache
+HISTORY_DIR = os.path.join(CACHE_DIR, "history")
+HISTORY_BACKFILL_CONCURRENCY = int(os.environ.get("HISTORY_BACKFILL_CONCURRENCY", 2))
+# ETF-days of history kept in memory (LRU); history scans read through without filling it
+HISTORY_CACHE_DAYS = int(os.environ.get("HISTORY_CACHE_DAYS", 64))
 
-class ETFProcessor:
-    def __init__(self):
-        self.file_map = {
-            "00981A": "https://drive.google.com/drive/folders/1mK6gf2kYPA2Mkh-JqG5J197nJQ8KONOd",
-            "00980A": "https://drive.google.com/drive/folders/1OpCjYlQJaO6nE0PTpddXz8AmXN3-hEZF",
-            "00982A": "https://drive.google.com/drive/folders/1moHqmiJdPLxfaH7jJjYd_WFRN2fbgwla",
-            "00985A": "https://drive.google.com/drive/folders/1DAK6cKsIAKRPB7gjgTrjZ5K9rqXKdhH8"
+FILE_LINK_RE = re.compile(r"/file/d/([a-zA-Z0-9_-]+)/")
+DOC_ID_TITLE_RE = re.compile(r'"doc_id"\s*:\s*"(?P<id>[a-zA-Z0-9_-]+)"[^{}]{0,200}?"title"\s*:\s*"(?P<name>[^"]+)"')
+FILE_DATE_RE = re.compile(r'(202[0-9])[-]?([0-1][0-9])[-]?([0-3][0-9])')
+
+# Holdings header detection: a header row names both a ticker column and a shares column
+TICKER_HEADER_RE = re.compile("|".join(map(re.escape, ['股票代號', '股票代碼', '證券代號', 'Code', 'Symbol', 'Ticker'])))
+SHARES_HEADER_RE = re.compile("|".join(map(re.escape, ['股數', 'Shares', 'Vol', 'Volume', '持股', '持有股數', 'Units', 'Quantity'])))
+# Rows buffered per sheet while looking for that header
+HEADER_SCAN_ROWS = int(os.environ.get("HEADER_SCAN_ROWS", 50))
+# Change-row actions, indexed by the code build_rows computes for each row
+ROW_ACTIONS = ("Added", "Removed", "Changed")
+
+# TWSE MIS quote API; accepts several "ex_ch" channels joined by "|"
+MIS_URL = os.environ.get("MIS_BASE_URL", "https://mis.twse.com.tw") + "/stock/api/getStockInfo.jsp"
+TWSE_STOCK_DAY_URL = os.environ.get("TWSE_BASE_URL", "https://www.twse.com.tw") + "/exchangeReport/STOCK_DAY"
+MIS_BATCH_SIZE = 50  # channels per request, keeps the query string well under MIS limits
+# Lookups from concurrently finishing ETFs are pooled this long (seconds) before one MIS fetch
+MIS_BATCH_WINDOW = float(os.environ.get("MIS_BATCH_WINDOW", 0.25))
+
+# Upstream base URLs can point at a local stand-in (see benchmarks/standin_server.py)
+DRIVE_BASE_URL = os.environ.get("DRIVE_BASE_URL", "https://drive.google.com")
+# Direct download endpoint; confirm=t skips the virus-scan interstitial for larger files
+DRIVE_DOWNLOAD_URL = (os.environ.get("DRIVE_DOWNLOAD_BASE_URL", "https://drive.usercontent.google.com")
+                      + "/download?id={fid}&export=download&confirm=t")
+
+# Upstream providers by URL prefix. Request caps, rates and breakers below are keyed
+# by provider, so they still apply when a base URL points at a mirror or stand-in.
+PROVIDER_URLS = {
+    "drive": DRIVE_BASE_URL,
+    "drive_download": DRIVE_DOWNLOAD_URL.split("?")[0],
+    "mis": MIS_URL,
+    "twse": TWSE_STOCK_DAY_URL,
+}
+
+# Per-ETF pipelines run concurrently; each upstream provider gets its own request cap
+ETF_WORKERS = int(os.environ.get("ETF_WORKERS", 4))
+PROVIDER_LIMITS = {
+    "drive": int(os.environ.get("DRIVE_CONCURRENCY", 4)),
+    "drive_download": int(os.environ.get("DRIVE_CONCURRENCY", 4)),
+    "mis": int(os.environ.get("TWSE_CONCURRENCY", 2)),
+    "twse": int(os.environ.get("TWSE_CONCURRENCY", 2)),
+}
+# Token-bucket request rate per provider as (requests per second, burst). A 429, or a
+# 2xx whose body is unusable (how MIS and TWSE answer while blocking a client), halves
+# the provider's rate (down to HOST_MIN_RATE) and every success wins a little back.
+# STOCK_DAY blocks clients that go beyond about three requests per five seconds.
+PROVIDER_RATES = {
+    "mis": (float(os.environ.get("MIS_RATE", 1.3)), 1),
+    "twse": (float(os.environ.get("TWSE_RATE", 0.5)), 1),
+}
+HOST_MIN_RATE = 0.2
+# Price providers get a circuit breaker: once BREAKER_ERROR_RATE of the last
+# BREAKER_WINDOW calls failed, the provider is skipped for BREAKER_COOLDOWN seconds
+BREAKER_PROVIDERS = ("mis", "twse")
+BREAKER_WINDOW = 20
+BREAKER_MIN_CALLS = 5
+BREAKER_ERROR_RATE = 0.5
+BREAKER_COOLDOWN = int(os.environ.get("BREAKER_COOLDOWN", 60))
+HTTP_TIMEOUT = 15
+HTTP_MAX_CONNECTIONS = 32
+
+# Background refresh: default per-ETF rebuild interval, and how often the scheduler wakes up
+REFRESH_INTERVAL = int(os.environ.get("REFRESH_INTERVAL", 3600))
+DRIVE_POLL_INTERVAL = int(os.environ.get("DRIVE_POLL_INTERVAL", 300))
+
+# Tracked ETFs: a JSON file or an http(s) URL serving the same document (see parse_etf_registry)
+ETF_REGISTRY = os.environ.get("ETF_REGISTRY", os.path.join(os.path.dirname(os.path.abspath(__file__)), "etfs.json"))
+ETF_DEFAULT_PRIORITY = 5
+# ETFs at this priority or better (lower) are also checked for new Drive files on every poll
+ETF_HOT_PRIORITY = int(os.environ.get("ETF_HOT_PRIORITY", 1))
+
+# Price cache: past closes are kept forever, today's intraday quotes only briefly
+PRICE_CACHE_FILE = os.path.join(CACHE_DIR, "prices.sqlite3")
+PRICE_CACHE_MAX_ITEMS = 50_000
+INTRADAY_TTL = 300  # seconds
+
+class Metrics:
+    """Process-wide counters and stage timings, rendered in the Prometheus text format.
+
+    Stage timings are also recorded as spans into the trace of the refresh
+    running in the current context (see start_trace), which ends up in the
+    snapshot.
+    """
+
+    def __init__(self, prefix="etf"):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._counters = {}  # (name, labels) -> value
+        self._timings = {}  # (stage, labels) -> [count, total seconds, max seconds]
+        self._trace = contextvars.ContextVar("refresh_trace", default=None)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, stage, seconds, start=None, detail=None, **labels):
+        key = (stage, tuple(sorted(labels.items())))
+        with self._lock:
+            timing = self._timings.setdefault(key, [0, 0.0, 0.0])
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+        trace = self._trace.get()
+        if trace is not None:
+            span = {"stage": stage, **labels}
+            if detail is not None:
+                span["detail"] = detail
+            span["start"] = round((start if start is not None else time.perf_counter() - seconds) - trace["t0"], 4)
+            span["seconds"] = round(seconds, 4)
+            trace["spans"].append(span)
+
+    @contextmanager
+    def timer(self, stage, detail=None, **labels):
+        """Times the enclosed block (sync or async code) as one observation of stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, start=start, detail=detail, **labels)
+
+    def start_trace(self):
+        """Starts collecting spans for the current context (and tasks/threads started from it)."""
+        trace = {"t0": time.perf_counter(), "started_at": datetime.now().isoformat(timespec="seconds"), "spans": []}
+        self._trace.set(trace)
+        return trace
+
+    def finish_trace(self, trace):
+        """The trace as stored in the snapshot: total time, per-stage totals and the spans."""
+        self._trace.set(None)
+        stages = {}
+        for span in trace["spans"]:
+            name = span["stage"] if "source" not in span else f"{span['stage']}.{span['source']}"
+            total = stages.setdefault(name, {"count": 0, "seconds": 0.0})
+            total["count"] += 1
+            total["seconds"] = round(total["seconds"] + span["seconds"], 4)
+        return {
+            "started_at": trace["started_at"],
+            "total_seconds": round(time.perf_counter() - trace["t0"], 4),
+            "stages": stages,
+            "spans": sorted(trace["spans"], key=lambda span: span["start"]),
         }
-        self.price_cache = {}
-        os.makedirs(CACHE_DIR, exist_ok=True)
-        
-        # Configure robust session with retries
-        self.session = requests.Session()
-        retry_strategy = Retry(
-            total=3,
-            backoff_factor=1,
-            status_forcelist=[429, 500, 502, 503, 504],
-            allowed_methods=["HEAD", "GET", "OPTIONS"]
+
+    def render(self, gauges=()):
+        """Prometheus text exposition; gauges are extra (name, labels, value) samples."""
+        def fmt(name, labels, value):
+            label_str = ",".join(f'{k}="{v}"' for k, v in labels)
+            return f"{self.prefix}_{name}{{{label_str}}} {value}" if label_str else f"{self.prefix}_{name} {value}"
+
+        with self._lock:
+            counters = sorted(self._counters.items())
+            timings = sorted(self._timings.items())
+        lines = []
+        seen = set()
+        for (name, labels), value in counters:
+            if name not in seen:
+                lines.append(f"# TYPE {self.prefix}_{name} counter")
+                seen.add(name)
+            lines.append(fmt(name, labels, value))
+
+        if timings:
+            lines.append(f"# TYPE {self.prefix}_stage_seconds summary")
+        for (stage, labels), (count, total, _) in timings:
+            labels = (("stage", stage),) + labels
+            lines.append(fmt("stage_seconds_count", labels, count))
+            lines.append(fmt("stage_seconds_sum", labels, round(total, 6)))
+        if timings:
+            lines.append(f"# TYPE {self.prefix}_stage_seconds_max gauge")
+        for (stage, labels), (_, _, longest) in timings:
+            lines.append(fmt("stage_seconds_max", (("stage", stage),) + labels, round(longest, 6)))
+
+        seen = set()
+        for name, labels, value in gauges:
+            if name not in seen:
+                lines.append(f"# TYPE {self.prefix}_{name} gauge")
+                seen.add(name)
+            lines.append(fmt(name, tuple(sorted(labels.items())), value))
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+class PriceCache:
+    """Bounded in-memory LRU in front of a SQLite table of (code, date) -> price."""
+
+    def __init__(self, path, max_items=PRICE_CACHE_MAX_ITEMS, intraday_ttl=INTRADAY_TTL):
+        self.max_items = max_items
+        self.intraday_ttl = intraday_ttl
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self._mem = OrderedDict()  # (code, date) -> (price, expires_at or None)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS prices ("
+            " code TEXT NOT NULL, date TEXT NOT NULL, price REAL NOT NULL, expires_at REAL,"
+            " PRIMARY KEY (code, date))"
         )
-        adapter = HTTPAdapter(max_retries=retry_strategy)
-        self.session.mount("https://", adapter)
-        self.session.mount("http://", adapter)
+        self._db.commit()
 
-    # ---------------- Price Fetching ----------------
-    def get_mis_prices(self, code, date_str):
-        """TWSE MIS API for today's price."""
+    def _remember(self, key, value):
+        self._mem[key] = value
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_items:
+            self._mem.popitem(last=False)
+
+    def get_many(self, codes, date_str):
+        """Returns {code: price} for every code cached and still fresh for date_str."""
+        now = time.time()
+        found = {}
+        with self._lock:
+            on_disk = []
+            for code in codes:
+                value = self._mem.get((code, date_str))
+                if value is not None and (value[1] is None or value[1] > now):
+                    self._mem.move_to_end((code, date_str))
+                    found[code] = value[0]
+                else:
+                    on_disk.append(code)
+
+            for i in range(0, len(on_disk), 500):  # stay under SQLite's bound-variable limit
+                chunk = on_disk[i:i + 500]
+                rows = self._db.execute(
+                    f"SELECT code, price, expires_at FROM prices WHERE date = ? AND code IN ({','.join('?' * len(chunk))})",
+                    [date_str, *chunk],
+                ).fetchall()
+                for code, price, expires_at in rows:
+                    if expires_at is None or expires_at > now:
+                        self._remember((code, date_str), (price, expires_at))
+                        found[code] = price
+                        self.disk_hits += 1
+
+            self.hits += len(found)
+            self.misses += len(codes) - len(found)
+        return found
+
+    def get(self, code, date_str):
+        return self.get_many([code], date_str).get(code)
+
+    def put_rows(self, rows, intraday=False):
+        """Stores (code, date, price) rows; dates from today on expire after intraday_ttl.
+
+        intraday=True gives every row that expiry, for prices that only stand in
+        for the close of their date (a last traded price).
+        """
         today_str = datetime.now().strftime("%Y%m%d")
-        if date_str != today_str:
+        intraday_expiry = time.time() + self.intraday_ttl
+        records = [
+            (code, date_str, price, intraday_expiry if intraday or date_str >= today_str else None)
+            for code, date_str, price in rows
+        ]
+        with self._lock:
+            for code, date_str, price, expires_at in records:
+                self._remember((code, date_str), (price, expires_at))
+            self._db.executemany(
+                "INSERT OR REPLACE INTO prices (code, date, price, expires_at) VALUES (?, ?, ?, ?)",
+                records,
+            )
+            self._db.commit()
+
+    def put_many(self, code_prices, date_str, intraday=False):
+        self.put_rows(((code, date_str, price) for code, price in code_prices.items()), intraday)
+
+    def put(self, code, date_str, price):
+        self.put_rows([(code, date_str, price)])
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "disk_hits": self.disk_hits,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "memory_items": len(self._mem),
+                "memory_limit": self.max_items,
+            }
+
+class FileCache:
+    """Downloaded workbooks keyed by Drive file id, described by an index.json.
+
+    Each index entry records the ETF and date the file belongs to, its size and
+    content hash, when it was last used, and the files derived from it (parsed
+    holdings), which are evicted together with it. Lookups go through the
+    in-memory index instead of listing the directory.
+    """
+
+    def __init__(self, root, keep_per_etf=CACHE_KEEP_PER_ETF, max_bytes=CACHE_MAX_BYTES):
+        self.root = root
+        self.keep_per_etf = keep_per_etf
+        self.max_bytes = max_bytes
+        self._index_path = os.path.join(root, "index.json")
+        self._lock = threading.Lock()
+        self._dirty = False
+        self.evictions = 0
+        os.makedirs(root, exist_ok=True)
+        try:
+            with open(self._index_path, encoding="utf-8") as fh:
+                self._entries = json.load(fh)
+        except (OSError, ValueError):
+            self._entries = {}
+
+    def _save(self):
+        tmp_path = f"{self._index_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as fh:
+            json.dump(self._entries, fh, ensure_ascii=False)
+        os.replace(tmp_path, self._index_path)
+        self._dirty = False
+
+    def _remove(self, fid):
+        entry = self._entries.pop(fid)
+        for path in [entry["path"], *entry["derived"]]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def _entry_bytes(entry):
+        return entry["size"] + sum(entry["derived"].values())
+
+    def path_for(self, fid, name):
+        """Where the file with this id is stored; keeps the extension for the Excel readers."""
+        return os.path.join(self.root, fid + (os.path.splitext(name)[1].lower() or ".xlsx"))
+
+    def get(self, fid):
+        """Index entry of a cached file, marked as just used; None if absent."""
+        with self._lock:
+            entry = self._entries.get(fid)
+            if entry is None:
+                return None
+            if not os.path.exists(entry["path"]):
+                self._remove(fid)
+                self._save()
+                return None
+            entry["used"] = time.time()
+            self._dirty = True
+            return entry
+
+    def add(self, fid, path, name, etf=None, date=None):
+        h = hashlib.sha1()
+        with open(path, "rb") as fh:
+            for block in iter(lambda: fh.read(1 << 20), b""):
+                h.update(block)
+        with self._lock:
+            if fid in self._entries and self._entries[fid]["path"] != path:
+                self._remove(fid)
+            derived = self._entries.get(fid, {}).get("derived", {})
+            self._entries[fid] = {
+                "path": path,
+                "name": name,
+                "etf": etf,
+                "date": date,
+                "size": os.path.getsize(path),
+                "sha1": h.hexdigest(),
+                "used": time.time(),
+                "derived": derived,
+            }
+            self._save()
+            return self._entries[fid]
+
+    def add_derived(self, fid, path):
+        """Ties a file built from fid to it, so it is evicted along with it."""
+        with self._lock:
+            entry = self._entries.get(fid)
+            if entry is not None and path not in entry["derived"]:
+                entry["derived"][path] = os.path.getsize(path)
+                self._save()
+
+    def discard(self, fid):
+        with self._lock:
+            if fid in self._entries:
+                self._remove(fid)
+                self._save()
+
+    def enforce(self, pinned=()):
+        """Evicts least recently used files with their derived files until under max_bytes.
+
+        The newest keep_per_etf dated files of every ETF and the pinned ids are
+        never evicted. Returns how many files were evicted.
+        """
+        with self._lock:
+            by_etf = {}
+            for fid, entry in self._entries.items():
+                if entry["etf"]:
+                    by_etf.setdefault(entry["etf"], []).append(fid)
+            protected = set(pinned)
+            for fids in by_etf.values():
+                fids.sort(key=lambda f: self._entries[f]["date"] or "", reverse=True)
+                protected.update(fids[:self.keep_per_etf])
+
+            total = sum(self._entry_bytes(e) for e in self._entries.values())
+            evicted = 0
+            if total > self.max_bytes:
+                candidates = sorted((f for f in self._entries if f not in protected),
+                                    key=lambda f: self._entries[f]["used"])
+                for fid in candidates:
+                    if total <= self.max_bytes:
+                        break
+                    total -= self._entry_bytes(self._entries[fid])
+                    self._remove(fid)
+                    evicted += 1
+            self.evictions += evicted
+            if evicted or self._dirty:
+                self._save()
+            return evicted
+
+    def stats(self):
+        with self._lock:
+            return {
+                "files": len(self._entries),
+                "bytes": sum(self._entry_bytes(e) for e in self._entries.values()),
+                "max_bytes": self.max_bytes,
+                "keep_per_etf": self.keep_per_etf,
+                "evictions": self.evictions,
+            }
+
+class TickerTable:
+    """Process-wide intern table for holdings.
+
+    Every ticker gets a small integer id, and every security name is stored
+    once and shared. Holdings, diffs and API rows refer to these instead of
+    carrying their own copies of the strings.
+    """
+
+    def __init__(self):
+        self._ids = {}
+        self._tickers = []
+        self._names = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._tickers)
+
+    def intern(self, tickers):
+        """int32 ids for tickers, assigning new ids to tickers not seen before."""
+        with self._lock:
+            out = np.empty(len(tickers), dtype=np.int32)
+            for i, ticker in enumerate(tickers):
+                tid = self._ids.get(ticker)
+                if tid is None:
+                    tid = self._ids[ticker] = len(self._tickers)
+                    self._tickers.append(ticker)
+                out[i] = tid
+            return out
+
+    def intern_names(self, names):
+        """Object array of names in which equal names are the same string object."""
+        with self._lock:
+            out = np.empty(len(names), dtype=object)
+            out[:] = [self._names.setdefault(name, name) for name in names]
+            return out
+
+    def find(self, ticker):
+        """Id of an already interned ticker, or None."""
+        return self._ids.get(ticker)
+
+    def lookup(self, ids):
+        """Object array of the ticker strings behind ids."""
+        out = np.empty(len(ids), dtype=object)
+        out[:] = [self._tickers[i] for i in ids.tolist()]
+        return out
+
+ticker_table = TickerTable()
+
+class Holdings:
+    """One ETF-day of holdings as parallel typed arrays, sorted by ticker id.
+
+    ids are unique TickerTable ids. A ticker listed more than once in a file
+    has its shares and weights summed into a single entry.
+    """
+
+    __slots__ = ("ids", "names", "shares", "weights")
+    COLUMNS = ["ticker", "name", "shares", "weight"]
+
+    def __init__(self, ids, names, shares, weights):
+        self.ids = ids
+        self.names = names
+        self.shares = shares
+        self.weights = weights
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def from_columns(cls, tickers, names, shares, weights):
+        ids = ticker_table.intern(tickers)
+        order = np.argsort(ids, kind="stable")
+        ids, names = ids[order], ticker_table.intern_names(names)[order]
+        shares = np.asarray(shares, dtype=np.float64)[order]
+        weights = np.asarray(weights, dtype=np.float64)[order]
+        if len(ids):
+            first = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+            if len(first) < len(ids):
+                shares = np.add.reduceat(shares, first)
+                weights = np.add.reduceat(weights, first)
+                ids, names = ids[first], names[first]
+        return cls(ids, names, shares, weights)
+
+    @classmethod
+    def from_frame(cls, df):
+        """From a canonical (ticker, name, shares, weight) DataFrame as parse_holdings returns it."""
+        return cls.from_columns(df["ticker"].tolist(), df["name"].tolist(),
+                                df["shares"].to_numpy(dtype=np.float64), df["weight"].to_numpy(dtype=np.float64))
+
+    @classmethod
+    def read_parquet(cls, path):
+        """Straight from the Parquet columns, without going through a DataFrame."""
+        table = parquet.read_table(path, columns=cls.COLUMNS, memory_map=True)
+        return cls.from_columns(table.column("ticker").to_pylist(), table.column("name").to_pylist(),
+                                table.column("shares").to_numpy(), table.column("weight").to_numpy())
+
+    def write_parquet(self, path):
+        parquet.write_table(pyarrow.table({
+            "ticker": ticker_table.lookup(self.ids).tolist(),
+            "name": self.names.tolist(),
+            "shares": self.shares,
+            "weight": self.weights,
+        }), path)
+
+    def find(self, ticker):
+        """Position of ticker in the arrays, or None."""
+        tid = ticker_table.find(ticker)
+        if tid is None:
             return None
+        i = int(np.searchsorted(self.ids, tid))
+        return i if i < len(self.ids) and self.ids[i] == tid else None
+
+class HoldingsDiff:
+    """Two Holdings outer-joined on ticker id with a sorted merge.
+
+    Shares are 0 on the side a ticker is missing from. The name comes from
+    the newer file when the ticker is in it.
+    """
+
+    __slots__ = ("ids", "names", "old_shares", "new_shares")
+
+    def __init__(self, old, new):
+        self.ids = np.union1d(old.ids, new.ids)
+        pos_old = np.searchsorted(self.ids, old.ids)
+        pos_new = np.searchsorted(self.ids, new.ids)
+        self.old_shares = np.zeros(len(self.ids))
+        self.old_shares[pos_old] = old.shares
+        self.new_shares = np.zeros(len(self.ids))
+        self.new_shares[pos_new] = new.shares
+        self.names = np.empty(len(self.ids), dtype=object)
+        self.names[pos_old] = old.names
+        self.names[pos_new] = new.names
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def delta_shares(self):
+        return self.new_shares - self.old_shares
+
+class HoldingRow:
+    """One change or holding row of the API.
+
+    Slotted instead of a dict per row, but it still reads like a mapping
+    (row["ticker"], keys(), dict(row)) for the endpoints and the JSON encoder.
+    """
+
+    __slots__ = ("ticker", "name", "old_shares", "new_shares", "delta_shares", "price",
+                 "monetary_value", "monetary_value_str", "action")
+
+    def __init__(self, ticker, name, old_shares, new_shares, delta_shares, price,
+                 monetary_value, monetary_value_str, action):
+        self.ticker = ticker
+        self.name = name
+        self.old_shares = old_shares
+        self.new_shares = new_shares
+        self.delta_shares = delta_shares
+        self.price = price
+        self.monetary_value = monetary_value
+        self.monetary_value_str = monetary_value_str
+        self.action = action
+
+    def keys(self):
+        return self.__slots__
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def to_dict(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
+    def __repr__(self):
+        return f"HoldingRow({self.to_dict()!r})"
+
+class HoldingsStore:
+    """Append-only store of daily holdings per ETF, one Parquet partition per (etf, date).
+
+    Partitions live at <root>/etf=<code>/date=<YYYYMMDD>/part.parquet and are
+    never rewritten. Each ETF-day is one compact Holdings, read on use and
+    kept in a bounded LRU; a ticker's history is one binary search per day.
+    """
+
+    def __init__(self, root, max_days=HISTORY_CACHE_DAYS):
+        self.root = root
+        self.max_days = max_days
+        self._lock = threading.Lock()
+        self._days = set()  # (etf, date) of every stored day
+        self._cache = OrderedDict()  # (etf, date) -> Holdings, least recently used first
+        os.makedirs(root, exist_ok=True)
+        self._load()
+
+    def _partition_path(self, etf, date_str):
+        return os.path.join(self.root, f"etf={etf}", f"date={date_str}", "part.parquet")
+
+    def _load(self):
+        for etf_dir in sorted(os.listdir(self.root)):
+            if not etf_dir.startswith("etf="):
+                continue
+            for date_dir in sorted(os.listdir(os.path.join(self.root, etf_dir))):
+                path = os.path.join(self.root, etf_dir, date_dir, "part.parquet")
+                if date_dir.startswith("date=") and os.path.exists(path):
+                    self._days.add((etf_dir[4:], date_dir[5:]))
+
+    def _remember(self, key, holdings):
+        self._cache[key] = holdings
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_days:
+            self._cache.popitem(last=False)
+
+    def _day(self, etf, date_str, keep=True):
+        """The Holdings of one stored ETF-day, cached unless keep is False (caller holds the lock)."""
+        key = (etf, date_str)
+        holdings = self._cache.get(key)
+        if holdings is not None:
+            self._cache.move_to_end(key)
+            return holdings
+        holdings = Holdings.read_parquet(self._partition_path(etf, date_str))
+        if keep:
+            self._remember(key, holdings)
+        return holdings
+
+    def has(self, etf, date_str):
+        return (etf, date_str) in self._days
+
+    def append(self, etf, date_str, holdings):
+        """Adds one ETF-day of Holdings; existing days are left untouched."""
+        with self._lock:
+            if (etf, date_str) in self._days:
+                return False
+            path = self._partition_path(etf, date_str)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            holdings.write_parquet(f"{path}.tmp")
+            os.replace(f"{path}.tmp", path)
+            self._days.add((etf, date_str))
+            self._remember((etf, date_str), holdings)
+            return True
+
+    def etfs(self):
+        return sorted({etf for etf, _ in self._days})
+
+    def dates(self, etf):
+        return sorted(d for e, d in self._days if e == etf)
+
+    def holdings(self, etf, date_str):
+        """Holdings for one ETF-day, or None."""
+        with self._lock:
+            if (etf, date_str) not in self._days:
+                return None
+            return self._day(etf, date_str)
+
+    def ticker_history(self, ticker, start=None, end=None, etf=None):
+        """Rows (etf, date, shares, weight, name) for a ticker, ordered by date."""
+        rows = []
+        with self._lock:
+            for e, d in sorted(self._days, key=lambda key: (key[1], key[0])):
+                if (etf and e != etf) or not (start or "") <= d <= (end or "99999999"):
+                    continue
+                holdings = self._day(e, d, keep=False)
+                i = holdings.find(ticker)
+                if i is not None:
+                    rows.append((e, d, holdings.names[i], holdings.shares[i], holdings.weights[i]))
+        return pd.DataFrame(rows, columns=["etf", "date", "name", "shares", "weight"])
+
+class MicroBatcher:
+    """Pools concurrent lookups into one fetch per short window.
+
+    get(key, codes) adds codes to the pending batch for key. The batch is
+    fetched with fetch(codes, key) once `window` seconds have passed since
+    it was opened, or as soon as it holds max_size codes, and every caller
+    gets the results for its own codes. Batches belong to the event loop
+    that opened them.
+    """
+
+    def __init__(self, fetch, window, max_size):
+        self.fetch = fetch
+        self.window = window
+        self.max_size = max_size
+        self._pending = {}  # key -> open batch
+        self._running = set()
+
+    async def get(self, key, codes):
+        loop = asyncio.get_running_loop()
+        batch = self._pending.get(key)
+        if batch is None or batch["loop"] is not loop:
+            batch = {"codes": {}, "future": loop.create_future(), "loop": loop}
+            batch["timer"] = loop.call_later(self.window, self._flush, key, batch)
+            self._pending[key] = batch
+        batch["codes"].update(dict.fromkeys(codes))
+        if len(batch["codes"]) >= self.max_size:
+            self._flush(key, batch)
+        result = await asyncio.shield(batch["future"])
+        return {code: result[code] for code in codes if code in result}
+
+    def _flush(self, key, batch):
+        if self._pending.get(key) is not batch:
+            return
+        del self._pending[key]
+        batch["timer"].cancel()
+        task = batch["loop"].create_task(self._run(key, batch))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def _run(self, key, batch):
         try:
-            for prefix in ('tse_', 'otc_'):
-                url = f'https://mis.twse.com.tw/stock/api/getStockInfo.jsp?ex_ch={prefix}{code}.tw&json=1&delay=0'
-                time.sleep(random.uniform(0.5, 1.0))  # Increased delay to be nicer to the API
-                r = self.session.get(url, timeout=10)
+            batch["future"].set_result(await self.fetch(list(batch["codes"]), key))
+        except Exception as e:
+            batch["future"].set_exception(e)
+
+class ProviderUnavailable(Exception):
+    """Raised instead of sending a request while the provider's circuit breaker is open."""
+
+class TokenBucket:
+    """Request pacing for one provider that slows down on 429 and speeds back up on success.
+
+    Tokens are reserved up front, so concurrent callers each get their own
+    wait time instead of contending on a lock across the sleep. Shared by
+    every event loop and thread.
+    """
+
+    def __init__(self, rate, burst=1, min_rate=HOST_MIN_RATE):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Takes one token; returns how long the caller must wait before using it."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            return max(wait, self._blocked_until - now)
+
+    def throttled(self, retry_after=None):
+        """A 429: halve the rate and, if the server said how long, hold everyone off that long."""
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            if retry_after:
+                self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+
+    def succeeded(self):
+        with self._lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+class CircuitBreaker:
+    """Skips a failing provider for a cool-down instead of paying its timeouts per request.
+
+    Closed: calls go through and outcomes are recorded over a sliding window.
+    Open: allow() is False until the cool-down ends. Half-open: one probe call
+    goes through; its outcome closes or re-opens the breaker.
+    """
+
+    def __init__(self, name, window=BREAKER_WINDOW, min_calls=BREAKER_MIN_CALLS,
+                 error_rate=BREAKER_ERROR_RATE, cooldown=BREAKER_COOLDOWN):
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.cooldown = cooldown
+        self.state = "closed"
+        self._results = []  # last `window` outcomes, True for success
+        self._open_until = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def is_open(self):
+        """True while calls are refused and the cool-down has not ended (no probe is used up)."""
+        return self.state == "open" and time.monotonic() < self._open_until
+
+    def allow(self):
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() >= self._open_until:
+                self._set_state("half_open")
+            if self.state == "half_open" and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record(self, ok):
+        with self._lock:
+            if self.state == "half_open":
+                self._probing = False
+                self._results = []
+                if ok:
+                    self._set_state("closed")
+                else:
+                    self._trip()
+                return
+            if self.state == "open":
+                return
+            self._results = (self._results + [ok])[-self.window:]
+            failures = self._results.count(False)
+            if len(self._results) >= self.min_calls and failures / len(self._results) >= self.error_rate:
+                self._trip()
+
+    def _trip(self):
+        self._open_until = time.monotonic() + self.cooldown
+        self._results = []
+        self._set_state("open")
+        print(f"[breaker] {self.name} failing, skipped for {self.cooldown}s")
+
+    def _set_state(self, state):
+        self.state = state
+        metrics.inc("breaker_transitions_total", provider=self.name, state=state)
+
+class AsyncHTTP:
+    """Shared keep-alive httpx client with per-provider concurrency caps, rate limits and retries.
+
+    Retries follow the previous requests/urllib3 setup: 3 retries on connection
+    errors and 429/5xx, exponential backoff with factor 1, honouring Retry-After.
+    A URL belongs to the provider whose prefix in providers matches it most
+    closely, else to its hostname. Providers in rates are paced by a TokenBucket;
+    providers in breakers fail fast with ProviderUnavailable while their
+    CircuitBreaker is open.
+    The client and its asyncio primitives are bound to the running event loop.
+    """
+
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, providers, limits, rates, breakers=(), retries=3, backoff_factor=1):
+        # Longest prefix first, so a download endpoint wins over its site's base URL
+        self.prefixes = sorted(((url.rstrip("/"), name) for name, url in providers.items()),
+                               key=lambda item: len(item[0]), reverse=True)
+        self.limits = limits
+        self.buckets = {name: TokenBucket(rate, burst) for name, (rate, burst) in rates.items()}
+        self.breakers = {name: CircuitBreaker(name) for name in breakers}
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self._loop = None
+        self._client = None
+
+    def provider(self, url):
+        """Name of the provider serving url; its hostname when no provider prefix matches."""
+        for prefix, name in self.prefixes:
+            if url.startswith(prefix) and url[len(prefix):len(prefix) + 1] in ("", "/", "?", "#"):
+                return name
+        return urlparse(url).hostname
+
+    def available(self, url):
+        """False while the circuit breaker of url's provider is open (no probe is used up)."""
+        breaker = self.breakers.get(self.provider(url))
+        return breaker is None or not breaker.is_open()
+
+    def _bind(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._client = httpx.AsyncClient(
+                follow_redirects=True,
+                timeout=HTTP_TIMEOUT,
+                limits=httpx.Limits(
+                    max_connections=HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=HTTP_MAX_CONNECTIONS,
+                    keepalive_expiry=60,
+                ),
+            )
+            self._slots = {name: asyncio.Semaphore(n) for name, n in self.limits.items()}
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None and self._loop is asyncio.get_running_loop():
+            await self._client.aclose()
+        self._loop = None
+        self._client = None
+
+    def slot(self, url):
+        """Async context manager holding one of the concurrency slots of url's provider."""
+        self._bind()
+        return self._slots.get(self.provider(url)) or nullcontext()
+
+    async def _pace(self, provider):
+        """Waits for the provider's breaker to allow a call and for a token from its bucket."""
+        breaker = self.breakers.get(provider)
+        if breaker is not None and not breaker.allow():
+            metrics.inc("http_short_circuited_total", provider=provider)
+            raise ProviderUnavailable(f"{provider} is failing; skipped until its cool-down ends")
+        bucket = self.buckets.get(provider)
+        if bucket is None:
+            return
+        wait = bucket.reserve()
+        if wait > 0:
+            metrics.inc("http_sleep_seconds_total", wait, provider=provider, reason="pace")
+            await asyncio.sleep(wait)
+
+    def _record(self, provider, resp=None, body_ok=True):
+        """Feeds one attempt's outcome to the breaker and bucket.
+
+        resp is None for a transport error. Only a response below 400 whose
+        body was usable (body_ok) is a success; a 2xx with an unusable body is
+        treated as a block and slows the bucket down like a 429.
+        """
+        ok = resp is not None and resp.status_code < 400 and body_ok
+        breaker = self.breakers.get(provider)
+        if breaker is not None:
+            breaker.record(ok)
+        bucket = self.buckets.get(provider)
+        if bucket is None:
+            return
+        if resp is not None and resp.status_code == 429:
+            metrics.inc("http_rate_limited_total", provider=provider)
+            retry_after = resp.headers.get("Retry-After", "")
+            bucket.throttled(float(retry_after) if retry_after.isdigit() else None)
+        elif resp is not None and not body_ok:
+            metrics.inc("http_rate_limited_total", provider=provider)
+            bucket.throttled()
+        elif ok:
+            bucket.succeeded()
+
+    def limiter_stats(self):
+        return {
+            "rates": {name: round(b.rate, 3) for name, b in self.buckets.items()},
+            "breakers": {name: b.state for name, b in self.breakers.items()},
+        }
+
+    def _backoff(self, attempt, resp=None):
+        if resp is not None and resp.headers.get("Retry-After", "").isdigit():
+            return float(resp.headers["Retry-After"])
+        return 0 if attempt == 0 else self.backoff_factor * (2 ** attempt)
+
+    async def _retry_sleep(self, provider, attempt, resp=None):
+        delay = self._backoff(attempt, resp)
+        metrics.inc("http_retries_total", provider=provider)
+        metrics.inc("http_sleep_seconds_total", delay, provider=provider, reason="backoff")
+        await asyncio.sleep(delay)
+
+    async def _send(self, url, parse=None, **kwargs):
+        """GET with retries; returns (last response, parsed body), even if the status is still retryable.
+
+        parse(resp) runs on 2xx responses; a ValueError from it counts as a
+        failure of the provider and leaves the body None.
+        """
+        client = self._bind()
+        provider = self.provider(url)
+        for attempt in range(self.retries + 1):
+            await self._pace(provider)
+            try:
+                resp = await client.get(url, **kwargs)
+            except httpx.TransportError:
+                metrics.inc("http_requests_total", provider=provider, status="error")
+                self._record(provider)
+                if attempt == self.retries:
+                    raise
+                await self._retry_sleep(provider, attempt)
+                continue
+            metrics.inc("http_requests_total", provider=provider, status=resp.status_code)
+            body, body_ok = None, True
+            if parse is not None and resp.is_success:
                 try:
-                    data = r.json()
+                    body = parse(resp)
                 except ValueError:
-                     # If response is not JSON (e.g. empty or HTML error page), skip
-                    continue
-                
-                if 'msgArray' in data:
-                    for item in data['msgArray']:
-                        if item.get('c') != code:
+                    body_ok = False
+            self._record(provider, resp, body_ok)
+            if resp.status_code not in self.RETRY_STATUSES or attempt == self.retries:
+                return resp, body
+            await self._retry_sleep(provider, attempt, resp)
+
+    async def get(self, url, **kwargs):
+        async with self.slot(url):
+            return (await self._send(url, **kwargs))[0]
+
+    async def get_json(self, url, **kwargs):
+        """GET a JSON object; raises for an error status or a body that is not one.
+
+        MIS and TWSE answer with an empty or HTML page while throttling, so
+        such bodies count against the provider's breaker and rate.
+        """
+        async with self.slot(url):
+            resp, data = await self._send(url, parse=self._json_object, **kwargs)
+        resp.raise_for_status()
+        if data is None:
+            raise ValueError(f"Expected JSON from {url}, got {resp.headers.get('content-type')!r} "
+                             f"({len(resp.content)} bytes)")
+        return data
+
+    @staticmethod
+    def _json_object(resp):
+        data = resp.json()
+        if not isinstance(data, dict):
+            raise ValueError("not a JSON object")
+        return data
+
+    async def download(self, url, path, verify=None):
+        """Streams url into path; refuses HTML bodies (Drive error / confirm pages).
+
+        The body goes to path + ".part" and is renamed onto path only once it
+        is complete and the coroutine verify(part_path) has not raised, so path
+        never holds a truncated file. A leftover .part file is resumed with a
+        Range request.
+        """
+        part = f"{path}.part"
+        provider = self.provider(url)
+        async with self.slot(url):
+            client = self._bind()
+            for attempt in range(self.retries + 1):
+                await self._pace(provider)
+                offset = os.path.getsize(part) if os.path.exists(part) else 0
+                headers = {"Range": f"bytes={offset}-"} if offset else {}
+                try:
+                    async with client.stream("GET", url, headers=headers) as resp:
+                        metrics.inc("http_requests_total", provider=provider, status=resp.status_code)
+                        self._record(provider, resp)
+                        if resp.status_code == 416:
+                            # Stale .part (the file changed or is already complete); start over
+                            if offset:
+                                os.remove(part)
+                            if attempt == self.retries:
+                                raise ValueError(f"Download from {url} kept failing with 416 Range Not Satisfiable")
                             continue
-                        c_val = item.get('z') or item.get('oz') or item.get('ob')
-                        if not c_val or c_val == '-' or float(item.get('y') or 0) == 0:
+                        if resp.status_code in self.RETRY_STATUSES and attempt < self.retries:
+                            await self._retry_sleep(provider, attempt, resp)
                             continue
-                        return float(c_val)
-        except Exception as e:
-            print(f"[MIS] {code} MIS API 請求失敗: {e}")
+                        resp.raise_for_status()
+                        if resp.headers.get("content-type", "").startswith("text/html"):
+                            raise ValueError(f"Expected a file but got an HTML page from {url}")
+
+                        # 206 continues the .part file, 200 means the server ignored Range
+                        resumed = resp.status_code == 206
+                        expected = self._expected_size(resp, offset if resumed else 0)
+                        with open(part, "ab" if resumed else "wb") as fh:
+                            async for chunk in resp.aiter_bytes(1 << 16):
+                                fh.write(chunk)
+                except httpx.TransportError:
+                    metrics.inc("http_requests_total", provider=provider, status="error")
+                    self._record(provider)
+                    if attempt == self.retries:
+                        raise
+                    await self._retry_sleep(provider, attempt)
+                    continue
+
+                size = os.path.getsize(part)
+                if expected is not None and size != expected:
+                    metrics.inc("http_retries_total", provider=provider)
+                    if attempt == self.retries:
+                        raise ValueError(f"Incomplete download from {url}: {size} of {expected} bytes")
+                    continue
+                try:
+                    if verify:
+                        await verify(part)
+                except Exception:
+                    os.remove(part)
+                    raise
+                os.replace(part, path)
+                return path
+
+    @staticmethod
+    def _expected_size(resp, offset):
+        """Total file size announced by the response, if any."""
+        content_range = resp.headers.get("content-range", "")
+        if "/" in content_range and content_range.rsplit("/", 1)[1].isdigit():
+            return int(content_range.rsplit("/", 1)[1])
+        length = resp.headers.get("content-length", "")
+        if length.isdigit() and "content-encoding" not in resp.headers:
+            return offset + int(length)
         return None
 
-    def get_twse_prices(self, code, date_str):
+def parse_etf_registry(raw):
+    """ETF registry entries by code, from the registry JSON document.
+
+    The document is {"etfs": [...]} (or just the list). Each entry needs a
+    "code" and a Drive "folder" URL, and may set "priority" (lower is more
+    important, default ETF_DEFAULT_PRIORITY) and "refresh_interval" in
+    seconds (default REFRESH_INTERVAL; 0 means only when a client asks for
+    it, once the last build is REFRESH_INTERVAL old). Entries with
+    "enabled": false are skipped. Raises ValueError.
+    """
+    doc = json.loads(raw)
+    entries = doc.get("etfs") if isinstance(doc, dict) else doc
+    if not isinstance(entries, list):
+        raise ValueError("expected a list of ETFs under 'etfs'")
+    registry = {}
+    for i, entry in enumerate(entries):
+        if not isinstance(entry, dict) or not entry.get("code") or not entry.get("folder"):
+            raise ValueError(f"entry {i} needs a 'code' and a 'folder'")
+        if entry.get("enabled", True) is False:
+            continue
+        try:
+            registry[str(entry["code"])] = {
+                "folder": entry["folder"],
+                "priority": int(entry.get("priority", ETF_DEFAULT_PRIORITY)),
+                "refresh_interval": int(entry.get("refresh_interval", REFRESH_INTERVAL)),
+            }
+        except (TypeError, ValueError):
+            raise ValueError(f"entry {i} ({entry['code']}): priority and refresh_interval must be integers")
+    return registry
+
+class ETFProcessor:
+    def __init__(self):
+        self.registry = {}  # code -> {"folder", "priority", "refresh_interval"}
+        self.file_map = {}  # code -> Drive folder URL, the ETFs every pipeline method works on
+        self._registry_digest = None
+        self.reload_registry()
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        self.price_cache = PriceCache(PRICE_CACHE_FILE)
+        self.history = HoldingsStore(HISTORY_DIR)
+        self.files = FileCache(FILES_DIR)
+        self._remove_legacy_downloads()
+        self.mis_exchange = {}  # code -> 'tse' / 'otc', learned from MIS responses
+        self.yf_suffix = {}  # code -> '.TW' / '.TWO', whichever Yahoo answered for
+        self.twse_months = {}  # (code, 'YYYYMM') -> {"closes": {date: close}, "final": bool}
+        self.compared_files = {}  # etf -> [latest id, previous id] used by the last get_real_data
+        self.prepared = {}  # etf -> last merged comparison, reused while its two files stay the newest
+        self.price_inflight = {}  # (code, date) -> future of the lookup currently fetching it
+        # All ETFs' MIS lookups share batched requests instead of one paced request each
+        self.mis_batcher = MicroBatcher(self._afetch_mis_prices, MIS_BATCH_WINDOW, MIS_BATCH_SIZE)
+        self.download_inflight = {}  # file id -> task currently downloading it
+        self.verified_files = {}  # path -> (size, mtime) of the last copy that passed verify_download
+
+        # Shared async HTTP client (keep-alive pool, retries, per-host limits and pacing)
+        self.http = AsyncHTTP(PROVIDER_URLS, PROVIDER_LIMITS, PROVIDER_RATES, BREAKER_PROVIDERS)
+        # yfinance goes through its own HTTP stack, so it only gets a breaker
+        self.yf_breaker = CircuitBreaker("yfinance")
+        # Excel parsing and merging are CPU/disk bound and run here, off the event loop
+        self.executor = ThreadPoolExecutor(max_workers=ETF_WORKERS, thread_name_prefix="etf")
+
+    # ---------------- ETF Registry ----------------
+    def reload_registry(self):
+        """Loads ETF_REGISTRY again if it changed; a broken or unreachable registry keeps the current ETFs."""
+        try:
+            if ETF_REGISTRY.startswith(("http://", "https://")):
+                resp = httpx.get(ETF_REGISTRY, timeout=HTTP_TIMEOUT, follow_redirects=True)
+                resp.raise_for_status()
+                raw = resp.content
+            else:
+                with open(ETF_REGISTRY, "rb") as fh:
+                    raw = fh.read()
+            digest = hashlib.sha1(raw).hexdigest()
+            if digest == self._registry_digest:
+                return False
+            registry = parse_etf_registry(raw)
+        except (OSError, httpx.HTTPError, ValueError) as e:
+            print(f"[registry] {ETF_REGISTRY} not loaded: {e}")
+            return False
+        self.registry = registry
+        self.file_map = {code: entry["folder"] for code, entry in registry.items()}
+        self._registry_digest = digest
+        print(f"[registry] {len(registry)} ETF(s) from {ETF_REGISTRY}")
+        return True
+
+    def etf_entry(self, etf_code):
+        """Registry settings of an ETF; ETFs put straight into file_map get the defaults."""
+        return self.registry.get(etf_code) or {
+            "folder": self.file_map.get(etf_code),
+            "priority": ETF_DEFAULT_PRIORITY,
+            "refresh_interval": REFRESH_INTERVAL,
+        }
+
+    def etfs_by_priority(self, etfs=None):
+        """ETF codes, most important first, registry order on ties.
+
+        Like every method here taking etfs, None means every ETF in file_map.
+        """
+        etfs = list(self.file_map if etfs is None else etfs)
+        return sorted(etfs, key=lambda code: self.etf_entry(code)["priority"])
+
+    def _in_executor(self, fn, *args):
+        """Runs fn on the parsing pool with the caller's context, so its timings join the refresh trace."""
+        ctx = contextvars.copy_context()
+        return asyncio.get_running_loop().run_in_executor(self.executor, ctx.run, fn, *args)
+
+    def _run_sync(self, coro):
+        """Runs one of the async methods to completion for synchronous callers (scripts, REPL)."""
+        async def runner():
+            try:
+                return await coro
+            finally:
+                await self.http.aclose()
+        return asyncio.run(runner())
+
+    # ---------------- Price Fetching ----------------
+    def _parse_mis_item(self, item):
+        c_val = item.get('z') or item.get('oz') or item.get('ob')
+        try:
+            if not c_val or c_val == '-' or float(item.get('y') or 0) == 0:
+                return None
+            return float(c_val)
+        except ValueError:
+            return None
+
+    async def aget_mis_prices_batch(self, codes, date_str):
+        """TWSE MIS API for today's prices, packing many symbols into each request.
+
+        Codes asked for by concurrent callers (one per ETF during a refresh)
+        are pooled by mis_batcher and fetched together.
+        """
+        today_str = datetime.now().strftime("%Y%m%d")
+        if date_str != today_str or not self.http.available(MIS_URL):
+            return {}
+        codes = [c for c in dict.fromkeys(codes) if c]
+        if not codes:
+            return {}
+        return await self.mis_batcher.get(date_str, codes)
+
+    async def _afetch_mis_prices(self, codes, date_str):
+        """One pooled MIS lookup: MIS_BATCH_SIZE channels per request, requests run concurrently."""
+        # Symbols with a known exchange need one channel, unknown ones are asked on both
+        channels = []
+        for code in dict.fromkeys(c for c in codes if c):
+            ex = self.mis_exchange.get(code)
+            if ex:
+                channels.append(f"{ex}_{code}.tw")
+            else:
+                channels.extend([f"tse_{code}.tw", f"otc_{code}.tw"])
+
+        async def fetch_chunk(chunk):
+            # Spacing between chunks comes from the MIS token bucket, not sleeps here
+            url = f"{MIS_URL}?ex_ch={'|'.join(chunk)}&json=1&delay=0"
+            try:
+                data = await self.http.get_json(url, timeout=10)
+                return data.get('msgArray', [])
+            except ProviderUnavailable:
+                return []
+            except Exception as e:
+                print(f"[MIS] 批次請求失敗 ({len(chunk)} symbols): {e}")
+                return []
+
+        chunks = [channels[i:i + MIS_BATCH_SIZE] for i in range(0, len(channels), MIS_BATCH_SIZE)]
+        prices = {}
+        for items in await asyncio.gather(*(fetch_chunk(c) for c in chunks)):
+            for item in items:
+                code = item.get('c')
+                if not code:
+                    continue
+                if item.get('ex') in ('tse', 'otc'):
+                    self.mis_exchange[code] = item['ex']
+                price = self._parse_mis_item(item)
+                if price is not None:
+                    prices[code] = price
+        return prices
+
+    def get_mis_prices_batch(self, codes, date_str):
+        return self._run_sync(self.aget_mis_prices_batch(codes, date_str))
+
+    def get_mis_prices(self, code, date_str):
+        """TWSE MIS API for today's price."""
+        return self.get_mis_prices_batch([code], date_str).get(code)
+
+    async def aget_twse_month(self, code, month_str):
+        """TWSE Stock Day Report for one stock-month, parsed once into a date -> close map."""
+        key = (code, month_str)
+        entry = self.twse_months.get(key)
+        if entry and entry['final']:
+            return entry['closes']
+
+        url = f'{TWSE_STOCK_DAY_URL}?response=json&date={month_str}01&stockNo={code}'
+        data = await self.http.get_json(url, timeout=10)
+
+        closes = {}
+        if data.get('stat') == 'OK' and data.get('data'):
+            for row in data['data']:
+                try:
+                    yy, mm, dd = row[0].split('/')
+                    closes[f"{int(yy) + 1911:04d}{mm}{dd}"] = float(row[6].replace(',', ''))
+                except (ValueError, IndexError):
+                    continue
+
+        # A month that has already ended never changes, so it is never fetched again
+        final = month_str < datetime.now().strftime("%Y%m")
+        self.twse_months[key] = {"closes": closes, "final": final}
+        # Every day of the month goes to the persistent cache, not just the one asked for
+        self.price_cache.put_rows((code, day_str, close) for day_str, close in closes.items())
+        return closes
+
+    async def aget_twse_prices(self, code, date_str):
         """TWSE Stock Day Report API for historical prices."""
         today_str = datetime.now().strftime("%Y%m%d")
         if date_str >= today_str:
             return None
+        if self.mis_exchange.get(code) == 'otc':
+            return None  # STOCK_DAY only covers TWSE listings
+
+        entry = self.twse_months.get((code, date_str[:6]))
+        if entry and (entry['final'] or date_str in entry['closes']):
+            return entry['closes'].get(date_str)
         try:
-            y, m = int(date_str[:4]), int(date_str[4:6])
-            month_first = f"{y}{m:02d}01"
-            url = f'https://www.twse.com.tw/exchangeReport/STOCK_DAY?response=json&date={month_first}&stockNo={code}'
-            r = self.session.get(url, timeout=10)
-            data = r.json()
-            if data.get('stat') == 'OK' and data.get('data'):
-                def to_roc_date(s):
-                    yy, mm, dd = s.split('/')
-                    return f"{int(yy) + 1911:04d}{mm}{dd}"
-                for row in data['data']:
-                    if to_roc_date(row[0]) == date_str:
-                        close_str = row[6]
-                        try:
-                            return float(close_str.replace(',', ''))
-                        except:
-                            return None
+            return (await self.aget_twse_month(code, date_str[:6])).get(date_str)
+        except ProviderUnavailable:
+            pass
         except Exception as e:
             print(f"[TWSE] {code} TWSE API 請求失敗: {e}")
         return None
 
-    def get_yf_prices(self, code, date_str):
-        """Yahoo Finance as a fallback."""
-        def try_yf(ticker):
-            try:
-                d = datetime.strptime(date_str, "%Y%m%d")
-                df = yf.Ticker(ticker).history(
-                    start=d.strftime('%Y-%m-%d'),
-                    end=(d + timedelta(days=1)).strftime('%Y-%m-%d')
-                )
-                if df.empty:
-                    return None
-                df = df.reset_index()
-                df['Date'] = df['Date'].dt.strftime('%Y%m%d')
-                idx_list = df.index[df['Date'] == date_str].tolist()
-                if not idx_list:
-                    return None
-                idx = idx_list[0]
-                return float(df.loc[idx, 'Close'])
-            except:
-                return None
-        
-        result = try_yf(f"{code}.TWO")
-        if result: return result
-        result = try_yf(f"{code}.TW")
-        if result: return result
-        
+    def get_twse_prices(self, code, date_str):
+        return self._run_sync(self.aget_twse_prices(code, date_str))
+
+    def get_yf_prices_batch(self, codes, date_str):
+        """Yahoo Finance as a fallback, one download for all symbols."""
+        codes = list(dict.fromkeys(c for c in codes if c))
+        if not codes:
+            return {}
+
+        # Codes with a known suffix skip the one that failed before; .TWO is tried first
+        candidates = {}
+        for code in codes:
+            suffix = self.yf_suffix.get(code)
+            candidates[code] = [suffix] if suffix else ['.TWO', '.TW']
+        tickers = [f"{code}{suffix}" for code, suffixes in candidates.items() for suffix in suffixes]
+        if not self.yf_breaker.allow():
+            return {}
+
         try:
-            ticker = yf.Ticker(f"{code}.TW")
-            return ticker.fast_info['lastPrice']
+            d = datetime.strptime(date_str, "%Y%m%d")
+            df = yf.download(
+                tickers,
+                start=d.strftime('%Y-%m-%d'),
+                end=(d + timedelta(days=1)).strftime('%Y-%m-%d'),
+                group_by='column',
+                auto_adjust=True,
+                progress=False,
+            )
+        except Exception as e:
+            print(f"[YF] 批次下載失敗 ({len(tickers)} tickers): {e}")
+            self.yf_breaker.record(False)
+            return {}
+        # yfinance reports failed symbols inside an empty or all-NaN frame rather
+        # than raising, so a batch only counts as a success if some close came back
+        prices = self._yf_closes(df, candidates, tickers, date_str)
+        self.yf_breaker.record(bool(prices))
+        return prices
+
+    def _yf_closes(self, df, candidates, tickers, date_str):
+        """Positive closes on date_str from a yf.download frame, remembering which suffix worked."""
+        if df is None or df.empty or 'Close' not in df:
+            return {}
+
+        close = df['Close']
+        if isinstance(close, pd.Series):
+            close = close.to_frame(tickers[0])
+        close.index = pd.DatetimeIndex(close.index).strftime('%Y%m%d')
+        if date_str not in close.index:
+            return {}
+        row = close.loc[date_str]
+        if isinstance(row, pd.DataFrame):
+            row = row.iloc[0]
+
+        prices = {}
+        for code, suffixes in candidates.items():
+            for suffix in suffixes:
+                p = row.get(f"{code}{suffix}")
+                if p is not None and pd.notna(p) and p > 0:
+                    prices[code] = float(p)
+                    self.yf_suffix[code] = suffix
+                    break
+        return prices
+
+    def get_yf_last_price(self, code):
+        """Yahoo Finance last traded price, regardless of date."""
+        if not self.yf_breaker.allow():
+            return None
+        try:
+            ticker = yf.Ticker(f"{code}{self.yf_suffix.get(code, '.TW')}")
+            price = ticker.fast_info['lastPrice']
         except:
+            self.yf_breaker.record(False)
             return None
+        ok = price is not None and pd.notna(price) and price > 0
+        self.yf_breaker.record(ok)
+        return price if ok else None
 
-    def get_stock_price(self, code, date_str=None):
-        """Fetches the latest price for a symbol using multiple sources."""
-        if not code:
-            return 0
-        
+    def get_yf_prices(self, code, date_str):
+        """Yahoo Finance as a fallback."""
+        result = self.get_yf_prices_batch([code], date_str).get(code)
+        if result: return result
+        return self.get_yf_last_price(code)
+
+    async def aget_stock_prices(self, codes, date_str=None):
+        """Fetches prices for many symbols, batching upstream calls where the source allows it."""
         if not date_str:
             date_str = datetime.now().strftime("%Y%m%d")
-            
-        cache_key = f"{code}_{date_str}"
-        if cache_key in self.price_cache:
-            return self.price_cache[cache_key]
-        
-        # Sequence: MIS -> TWSE -> YF
-        p = self.get_mis_prices(code, date_str)
-        if p is None:
-            p = self.get_twse_prices(code, date_str)
-        if p is None:
-            p = self.get_yf_prices(code, date_str)
-            
-        if p is not None:
-            # Cache it
-            self.price_cache[cache_key] = p
-            return p
-            
-        return 0
+
+        codes = list(dict.fromkeys(c for c in codes if c))
+        prices = self.price_cache.get_many(codes, date_str)
+        metrics.inc("prices_resolved_total", len(prices), source="cache")
+        missing = [c for c in codes if c not in prices]
+        if not missing:
+            return prices
+
+        # Codes another call is already fetching for this date are awaited, not fetched twice
+        shared = {}
+        mine = []
+        for code in missing:
+            inflight = self.price_inflight.get((code, date_str))
+            if inflight is not None:
+                shared[code] = inflight
+            else:
+                mine.append(code)
+
+        done = asyncio.get_running_loop().create_future()
+        for code in mine:
+            self.price_inflight[(code, date_str)] = done
+        found = {}
+        try:
+            if mine:
+                found = await self._afetch_prices(mine, date_str)
+        finally:
+            done.set_result(found)
+            for code in mine:
+                self.price_inflight.pop((code, date_str), None)
+        prices.update(found)
+
+        for code, inflight in shared.items():
+            other = await asyncio.shield(inflight)
+            if code in other:
+                prices[code] = other[code]
+        return prices
+
+    async def _afetch_prices(self, missing, date_str):
+        # Sequence: MIS (batched) -> TWSE (concurrent, host-limited) -> YF (batched) -> YF last price
+        with metrics.timer("price", source="mis"):
+            found = await self.aget_mis_prices_batch(missing, date_str)
+        metrics.inc("prices_resolved_total", len(found), source="mis")
+        # A provider whose breaker is open is skipped as a whole, not code by code
+        twse_codes = [c for c in missing if c not in found] if self.http.available(TWSE_STOCK_DAY_URL) else []
+        if twse_codes:
+            with metrics.timer("price", source="twse"):
+                twse_prices = await asyncio.gather(*(self.aget_twse_prices(c, date_str) for c in twse_codes))
+            twse_found = {c: p for c, p in zip(twse_codes, twse_prices) if p is not None}
+            metrics.inc("prices_resolved_total", len(twse_found), source="twse")
+            found.update(twse_found)
+
+        # yfinance is blocking; keep it off the event loop
+        unresolved = [c for c in missing if c not in found]
+        if unresolved:
+            with metrics.timer("price", source="yf"):
+                yf_found = await asyncio.to_thread(self.get_yf_prices_batch, unresolved, date_str)
+            metrics.inc("prices_resolved_total", len(yf_found), source="yf")
+            found.update(yf_found)
+        # The last traded price is not the close of date_str; it is only cached
+        # briefly so the dated providers are asked again once it expires
+        latest = {}
+        for code in unresolved:
+            if code not in found and not self.yf_breaker.is_open():
+                with metrics.timer("price", source="yf_last"):
+                    p = await asyncio.to_thread(self.get_yf_last_price, code)
+                if p is not None:
+                    metrics.inc("prices_resolved_total", source="yf_last")
+                    latest[code] = p
+
+        metrics.inc("prices_unresolved_total", len(missing) - len(found) - len(latest))
+        self.price_cache.put_many(found, date_str)
+        self.price_cache.put_many(latest, date_str, intraday=True)
+        return {**found, **latest}
+
+    def get_stock_prices(self, codes, date_str=None):
+        return self._run_sync(self.aget_stock_prices(codes, date_str))
+
+    def get_stock_price(self, code, date_str=None):
+        """Fetches the latest price for a symbol using multiple sources."""
+        if not code:
+            return 0
+        return self.get_stock_prices([code], date_str).get(code, 0)
 
     def format_twd_amount(self, n: float) -> str:
         """User preferred TWD formatting (1.2億, 345萬, etc.)."""
@@ -187,6 +1591,24 @@ class ETFProcessor:
         else:
             return f"{sign}{int(round(absn))}"
 
+    def format_twd_amounts(self, values):
+        """format_twd_amount over a whole array at once."""
+        n = np.asarray(values, dtype=float)
+        absn = np.abs(n)
+        out = np.full(n.shape, "—", dtype=object)
+
+        # Same rounding as the scalar version: "%.1f" for 億, round-half-even for 萬 and units
+        yi = absn >= 100_000_000
+        wan = (absn >= 10_000) & ~yi
+        unit = absn < 10_000
+        out[yi] = np.char.add(np.char.mod("%.1f", absn[yi] / 100_000_000), "億")
+        out[wan] = np.char.add(np.round(absn[wan] / 10_000).astype(np.int64).astype(str), "萬")
+        out[unit] = np.round(absn[unit]).astype(np.int64).astype(str)
+
+        negative = n < 0
+        out[negative] = np.char.add("-", out[negative].astype(str))
+        return out.tolist()
+
     # ---------------- Drive Helpers ----------------
     def _extract_folder_id(self, folder_url: str) -> str:
         m = re.search(r'/folders/([a-zA-Z0-9_-]+)', folder_url)
@@ -198,81 +1620,159 @@ class ETFProcessor:
     def _normalize_name(self, s: str) -> str:
         return re.sub(r'\s+', ' ', (s or '').strip()).lower()
 
-    def _list_from_embedded(self, folder_id: str):
-        url = f"https://drive.google.com/embeddedfolderview?id={folder_id}#list"
+    def _parse_embedded_html(self, html):
+        soup = bs4.BeautifulSoup(html, "lxml")
+        out = []
+        for a in soup.select("div#folder-view a[href*='?id=']"):
+            href = a.get("href", "")
+            name = (a.text or "").strip()
+            if "id=" in href:
+                fid = href.split("id=")[-1]
+                if fid and name:
+                    out.append({"name": name, "id": fid})
+        for a in soup.select("a"):
+            href = a.get("href", "") or ""
+            name = (a.text or "").strip()
+            m = FILE_LINK_RE.search(href)
+            if m and name:
+                out.append({"name": name, "id": m.group(1)})
+        return out
+
+    def _parse_drive_page_html(self, html):
+        soup = bs4.BeautifulSoup(html, "lxml")
+        out = []
+        for a in soup.select("a"):
+            href = a.get("href", "") or ""
+            text = (a.text or "").strip()
+            m = FILE_LINK_RE.search(href)
+            if m:
+                fid = m.group(1)
+                name = text or a.get("aria-label") or a.get("title") or ""
+                if name:
+                    out.append({"name": name, "id": fid})
+        if '"doc_id"' in html:
+            for m in DOC_ID_TITLE_RE.finditer(html):
+                out.append({"name": unquote(m.group("name")), "id": m.group("id")})
+        return out
+
+    async def _fetch_folder_view(self, url, validators):
+        """Conditional GET of a folder view; html is None when it has not changed since validators."""
+        headers = {}
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+        resp = await self.http.get(url, timeout=15, headers=headers)
+        if resp.status_code == 304:
+            return None, validators
+        resp.raise_for_status()
+
+        # Drive rarely sends validators, so an identical body also counts as unchanged
+        new_validators = {
+            "etag": resp.headers.get("ETag"),
+            "last_modified": resp.headers.get("Last-Modified"),
+            "body_hash": hashlib.sha1(resp.content).hexdigest(),
+        }
+        if new_validators["body_hash"] == validators.get("body_hash"):
+            return None, new_validators
+        return resp.text, new_validators
+
+    def _manifest_path(self, folder_id):
+        return os.path.join(MANIFEST_DIR, f"{folder_id}.json")
+
+    def _load_manifest(self, folder_id):
         try:
-            resp = self.session.get(url, timeout=15)
-            resp.raise_for_status()
-            soup = BeautifulSoup(resp.text, "html.parser")
-            out = []
-            for a in soup.select("div#folder-view a[href*='?id=']"):
-                href = a.get("href", "")
-                name = (a.text or "").strip()
-                if "id=" in href:
-                    fid = href.split("id=")[-1]
-                    if fid and name:
-                        out.append({"name": name, "id": fid})
-            for a in soup.select("a"):
-                href = a.get("href", "") or ""
-                name = (a.text or "").strip()
-                m = re.search(r"/file/d/([a-zA-Z0-9_-]+)/", href)
-                if m and name:
-                    out.append({"name": name, "id": m.group(1)})
-            return out
-        except Exception as e:
-            print(f"[list_from_embedded] Parse failed: {e}")
+            with open(self._manifest_path(folder_id), encoding="utf-8") as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            return {"files": [], "sources": {}}
+
+    def _save_manifest(self, folder_id, manifest):
+        os.makedirs(MANIFEST_DIR, exist_ok=True)
+        path = self._manifest_path(folder_id)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as fh:
+            json.dump(manifest, fh, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    async def sync_folder(self, folder_url: str):
+        """Lists a Drive folder against its stored manifest.
+
+        The embedded view is tried first; the full Drive page only when the
+        embedded view yields nothing. Returns the listed files; files not
+        present at the previous sync are logged.
+
+        Several callers sync the same folder, so "new since the last sync"
+        says nothing about what a given caller has seen. Callers compare file
+        ids against their own state instead (the prepared merge, the
+        snapshot's compared files, the history store).
+        """
+        folder_id = self._extract_folder_id(folder_url)
+        if not folder_id:
             return []
 
-    def _list_from_drive_page(self, folder_id: str):
-        url = f"https://drive.google.com/drive/folders/{folder_id}"
-        try:
-            resp = self.session.get(url, timeout=15)
-            resp.raise_for_status()
-            html = resp.text
-            soup = BeautifulSoup(html, "html.parser")
-            out = []
-            for a in soup.select("a"):
-                href = a.get("href", "") or ""
-                text = (a.text or "").strip()
-                m = re.search(r"/file/d/([a-zA-Z0-9_-]+)/", href)
-                if m:
-                    fid = m.group(1)
-                    name = text or a.get("aria-label") or a.get("title") or ""
-                    if name:
-                        out.append({"name": name, "id": fid})
-            for m in re.finditer(r'"doc_id"\s*:\s*"(?P<id>[a-zA-Z0-9_-]+)".{0,200}?"title"\s*:\s*"(?P<name>[^"]+)"', html, re.DOTALL):
-                fid = m.group("id")
-                name = unquote(m.group("name"))
-                out.append({"name": name, "id": fid})
-            return out
-        except Exception as e:
-            print(f"[list_from_drive_page] Parse failed: {e}")
+        manifest = self._load_manifest(folder_id)
+        known_ids = {f["id"] for f in manifest["files"]}
+        views = (
+            ("embedded", f"{DRIVE_BASE_URL}/embeddedfolderview?id={folder_id}#list", self._parse_embedded_html),
+            ("drive", f"{DRIVE_BASE_URL}/drive/folders/{folder_id}", self._parse_drive_page_html),
+        )
+
+        files = []
+        for source, url, parse in views:
+            state = manifest["sources"].get(source, {})
+            try:
+                html, validators = await self._fetch_folder_view(url, state)
+            except Exception as e:
+                print(f"[sync_folder] {source} view of {folder_id} failed: {e}")
+                continue
+
+            if html is None:
+                listed = state.get("files", [])
+            else:
+                # BeautifulSoup takes tens of ms on a large folder; parse on the pool.
+                # Same file can be linked several times; keep the first (name, id) pair
+                unique = {}
+                for it in await self._in_executor(parse, html):
+                    if it["name"] and it["id"]:
+                        unique.setdefault((it["name"], it["id"]), it)
+                listed = [{**it, "date": self._parse_file_date(it["name"])} for it in unique.values()]
+            manifest["sources"][source] = {**validators, "files": listed}
+            if listed:
+                files = listed
+                break
+
+        if not files:
             return []
 
+        new_files = [f for f in files if f["id"] not in known_ids]
+        manifest["files"] = files
+        manifest["synced_at"] = datetime.now().isoformat(timespec="seconds")
+        self._save_manifest(folder_id, manifest)
+        if new_files and known_ids:
+            print(f"[sync_folder] {folder_id}: {len(new_files)} new file(s): {[f['name'] for f in new_files]}")
+        return files
+
+    async def alist_folder_files(self, folder_url: str):
+        return await self.sync_folder(folder_url)
+
     def list_folder_files(self, folder_url: str):
-        folder_id = self._extract_folder_id(folder_url)
-        if not folder_id: return []
-        
-        items = []
-        seen = set()
-        for getter in (self._list_from_embedded, self._list_from_drive_page):
-            lst = getter(folder_id)
-            for it in lst:
-                name = it.get("name") or ""
-                fid = it.get("id") or ""
-                key = (name, fid)
-                if name and fid and key not in seen:
-                    seen.add(key)
-                    items.append({"name": name, "id": fid})
-        return items
+        return self._run_sync(self.alist_folder_files(folder_url))
+
+    def _parse_file_date(self, name):
+        match = FILE_DATE_RE.search(name)
+        return "".join(match.groups()) if match else None  # 20260105
 
     def find_latest_two_files(self, files):
+        return self.find_dated_files(files)[:2]
+
+    def find_dated_files(self, files):
+        """Files whose name carries a date, newest first."""
         valid_files = []
         for f in files:
             name = f['name']
-            match = re.search(r'(202[0-9])[-]?([0-1][0-9])[-]?([0-3][0-9])', name)
-            if match:
-                date_str = "".join(match.groups())  # 20260105
+            date_str = f.get('date') or self._parse_file_date(name)
+            if date_str:
                 valid_files.append({
                     "name": name,
                     "id": f['id'],
@@ -280,31 +1780,154 @@ class ETFProcessor:
                 })
         
         valid_files.sort(key=lambda x: x['date'], reverse=True)
-        return valid_files[:2]
+        return valid_files
+
+    def verify_download(self, path):
+        """Raises ValueError unless path looks like a complete workbook.
+
+        .xlsx files are zip archives and every member's CRC is checked; other
+        files must at least start with the zip or legacy .xls (OLE2) signature.
+        """
+        with open(path, "rb") as fh:
+            magic = fh.read(8)
+        if magic.startswith(b"PK\x03\x04"):
+            try:
+                with zipfile.ZipFile(path) as zf:
+                    bad = zf.testzip()
+            except zipfile.BadZipFile as e:
+                raise ValueError(f"Corrupt workbook {path}: {e}")
+            if bad is not None:
+                raise ValueError(f"Corrupt workbook {path}: bad CRC in {bad}")
+        elif magic != b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1":
+            raise ValueError(f"Not a workbook: {path}")
+
+    async def averify_download(self, path):
+        """verify_download on the parsing pool; testzip reads the whole file."""
+        await self._in_executor(self.verify_download, path)
+
+    def _cached_download_ok(self, path):
+        if not os.path.exists(path):
+            return False
+        st = os.stat(path)
+        if self.verified_files.get(path) == (st.st_size, st.st_mtime):
+            return True
+        try:
+            self.verify_download(path)
+        except ValueError as e:
+            print(f"⚠️ {e}; downloading it again")
+            os.remove(path)
+            return False
+        self.verified_files[path] = (st.st_size, st.st_mtime)
+        return True
+
+    async def adownload_file(self, file_info, etf_code=None):
+        """Local path of a Drive file, downloading it unless a verified copy is cached.
+
+        Concurrent calls for the same file id share one download.
+        """
+        fid = file_info['id']
+        task = self.download_inflight.get(fid)
+        if task is None:
+            task = asyncio.ensure_future(self._adownload_file(file_info, etf_code))
+            self.download_inflight[fid] = task
+            task.add_done_callback(lambda _: self.download_inflight.pop(fid, None))
+        return await asyncio.shield(task)
+
+    def _cached_download(self, fid):
+        """Path of the verified cached copy of fid, or None after dropping a missing or corrupt one."""
+        entry = self.files.get(fid)
+        if entry is None:
+            return None
+        if self._cached_download_ok(entry['path']):
+            return entry['path']
+        self.files.discard(fid)
+        return None
 
-    def download_file(self, file_info):
+    def _store_download(self, fid, path, fname, etf_code, date):
+        """Indexes a fresh download: hashes it and rewrites index.json."""
+        st = os.stat(path)
+        self.verified_files[path] = (st.st_size, st.st_mtime)
+        self.files.add(fid, path, fname, etf_code, date)
+
+    async def _adownload_file(self, file_info, etf_code):
         fname = file_info['name']
         fid = file_info['id']
-        path = os.path.join(CACHE_DIR, fname)
-        
-        if not os.path.exists(path):
-            print(f"⬇️ Downloading {fname}...")
-            url = f'https://drive.google.com/uc?id={fid}'
-            gdown.download(url, path, quiet=False)
+        # Cache checks and index updates hash files and rewrite index.json; keep them off the loop
+        cached = await self._in_executor(self._cached_download, fid)
+        if cached is not None:
+            metrics.inc("download_cache_total", result="hit")
+            return cached
+
+        metrics.inc("download_cache_total", result="miss")
+        path = self.files.path_for(fid, fname)
+        print(f"⬇️ Downloading {fname}...")
+        with metrics.timer("download", detail=fname):
+            await self.http.download(DRIVE_DOWNLOAD_URL.format(fid=fid), path, verify=self.averify_download)
+        await self._in_executor(self._store_download, fid, path, fname, etf_code, file_info.get('date'))
         return path
 
+    def download_file(self, file_info, etf_code=None):
+        return self._run_sync(self.adownload_file(file_info, etf_code))
+
     def find_stock_header_index(self, df_raw):
-        ticker_keywords = ['股票代號', '股票代碼', '證券代號', 'Code', 'Symbol', 'Ticker']
-        shares_keywords = ['股數', 'Shares', 'Vol', 'Volume', '持股', '持有股數', 'Units', 'Quantity']
-        
-        for idx, row in df_raw.iterrows():
-            cells = row.astype(str).tolist()
-            has_ticker = any(any(k in c for k in ticker_keywords) for c in cells)
-            has_shares = any(any(k in c for k in shares_keywords) for c in cells)
-            
-            if has_ticker and has_shares:
-                return idx
-        return None
+        """Label of the first row mentioning both a ticker and a shares keyword, or None."""
+        if df_raw.empty:
+            return None
+        cells = df_raw.to_numpy(dtype=object).astype(str)
+        flat = pd.Series(cells.ravel())
+
+        def rows_matching(pattern):
+            return flat.str.contains(pattern).to_numpy().reshape(cells.shape).any(axis=1)
+
+        hits = np.flatnonzero(rows_matching(TICKER_HEADER_RE) & rows_matching(SHARES_HEADER_RE))
+        return df_raw.index[hits[0]] if hits.size else None
+
+    def _table_from_rows(self, header, body):
+        """DataFrame from a header row and the data rows below it, named like read_excel(header=idx)."""
+        names, seen = [], {}
+        for i, c in enumerate(header):
+            name = f"Unnamed: {i}" if c is None or pd.isna(c) else str(c).strip()
+            if name in seen:
+                seen[name] += 1
+                name = f"{name}.{seen[name]}"
+            else:
+                seen[name] = 0
+            names.append(name)
+
+        df = pd.DataFrame(body, dtype=object).reindex(columns=range(len(names)))
+        df.columns = names
+        df = df.dropna(how="all").reset_index(drop=True)
+        # Empty cells as NaN, the way read_excel leaves them
+        return df.mask(df.isna())
+
+    def read_holdings_table(self, path):
+        """The table under the first recognisable header row of a workbook, or None.
+
+        Each sheet is streamed once in openpyxl read-only mode: only its first
+        HEADER_SCAN_ROWS rows are buffered while looking for the header, and the
+        rest of the same row iterator becomes the table.
+        """
+        try:
+            wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+        except (openpyxl.utils.exceptions.InvalidFileException, zipfile.BadZipFile):
+            # Legacy .xls: read every sheet once and slice the table out of it
+            for df_raw in pd.read_excel(path, sheet_name=None, header=None).values():
+                idx = self.find_stock_header_index(df_raw)
+                if idx is not None:
+                    pos = df_raw.index.get_loc(idx)
+                    return self._table_from_rows(df_raw.iloc[pos].tolist(), df_raw.iloc[pos + 1:].to_numpy())
+            return None
+
+        try:
+            for ws in wb.worksheets:
+                rows = ws.iter_rows(values_only=True)
+                head = list(itertools.islice(rows, HEADER_SCAN_ROWS))
+                idx = self.find_stock_header_index(pd.DataFrame(head, dtype=object))
+                if idx is not None:
+                    return self._table_from_rows(head[idx], itertools.chain(head[idx + 1:], rows))
+            return None
+        finally:
+            wb.close()
     
     def _parse_weight_to_float(self, x):
         try:
@@ -317,228 +1940,932 @@ class ETFProcessor:
     def clean_dataframe(self, df):
         pass
 
-    def get_real_data(self):
-        results = {}
-        dates_info = {"new": "", "old": ""}
+    async def aprepare_etf(self, etf_code, folder_url):
+        """List, download and merge one ETF; returns None when there is nothing to compare."""
+        print(f"Processing {etf_code} from {folder_url}...")
         
-        for etf_code, folder_url in self.file_map.items():
-            print(f"Processing {etf_code} from {folder_url}...")
-            
-            # 1. List files
-            all_files = self.list_folder_files(folder_url)
-            if not all_files:
-                print(f"Warning: No files found for {etf_code}")
-                results[etf_code] = []
-                continue
-            
-            # 2. Pick top 2 by date
-            target_files = self.find_latest_two_files(all_files)
-            if len(target_files) < 2:
-                print(f"Warning: Need at least 2 dated files for comparison, found {len(target_files)} for {etf_code}")
-                results[etf_code] = []
-                continue
-                
-            latest = target_files[0]
-            previous = target_files[1]
-            print(f"  Comparing {latest['date']} vs {previous['date']}")
-            
-            dates_info["new"] = latest['date']
-            dates_info["old"] = previous['date']
-            
-            # 3. Download
-            path_latest = self.download_file(latest)
-            path_old = self.download_file(previous)
+        # 1. List files
+        with metrics.timer("list", detail=etf_code):
+            all_files = await self.alist_folder_files(folder_url)
+        if not all_files:
+            print(f"Warning: No files found for {etf_code}")
+            return None
+        
+        # 2. Pick top 2 by date
+        target_files = self.find_latest_two_files(all_files)
+        if len(target_files) < 2:
+            print(f"Warning: Need at least 2 dated files for comparison, found {len(target_files)} for {etf_code}")
+            return None
             
-            comp_result = self.compare_files(path_old, path_latest, latest['date'])
-            if "error" in comp_result:
-                print(f"  Error comparing {etf_code}: {comp_result['error']}")
-                results[etf_code] = []
-            else:
-                results[etf_code] = comp_result['data']
+        latest = target_files[0]
+        previous = target_files[1]
+
+        # Nothing new in the folder: the previous merge for these two files is still valid
+        cached = self.prepared.get(etf_code)
+        if cached and cached['latest']['id'] == latest['id'] and cached['previous']['id'] == previous['id']:
+            return cached
+        print(f"  [{etf_code}] Comparing {latest['date']} vs {previous['date']}")
+        
+        # 3. Download
+        path_latest, path_old = await asyncio.gather(
+            self.adownload_file(latest, etf_code), self.adownload_file(previous, etf_code))
         
+        merge_result = await self._in_executor(
+            self.merge_holdings, path_old, path_latest, previous['id'], latest['id'])
+        if "error" in merge_result:
+            print(f"  Error comparing {etf_code}: {merge_result['error']}")
+            return None
+        prep = {"merged": merge_result['merged'], "latest": latest, "previous": previous}
+        self.prepared[etf_code] = prep
+
+        # Both files are parsed by now, so recording them in the history store is cheap
+        for file_info, path in ((previous, path_old), (latest, path_latest)):
+            await self._in_executor(self.record_history, etf_code, file_info, path)
+        return prep
+
+    async def _aprepare_etf_isolated(self, etf_code, folder_url):
+        try:
+            return await self.aprepare_etf(etf_code, folder_url)
+        except Exception:
+            print(f"  Error processing {etf_code}:")
+            print(traceback.format_exc())
+            return None
+
+    async def aiter_real_data(self, etfs=None):
+        """Yields (etf_code, prep or None, rows) for each ETF as soon as its own pipeline finishes.
+
+        Every ETF resolves its prices right after its merge; tickers shared with
+        an ETF still being priced are coalesced in aget_stock_prices.
+        """
+        async def run(etf_code, folder_url):
+            prep = await self._aprepare_etf_isolated(etf_code, folder_url)
+            if prep is None:
+                return etf_code, None, []
+            try:
+                merged = prep['merged']
+                with metrics.timer("pricing", detail=etf_code):
+                    prices = await self.aget_stock_prices(self.codes_needing_price(merged), prep['latest']['date'])
+                with metrics.timer("rows", detail=etf_code):
+                    return etf_code, prep, self.build_rows(merged, prices)
+            except Exception:
+                print(f"  Error pricing {etf_code}:")
+                print(traceback.format_exc())
+                return etf_code, None, []
+
+        # Started most important first, so they get the per-host request slots first
+        jobs = [run(code, self.file_map[code]) for code in self.etfs_by_priority(etfs)]
+        for next_done in asyncio.as_completed(jobs):
+            yield await next_done
+
+    async def aget_real_data(self, on_etf=None, etfs=None):
+        """Runs the ETFs concurrently, calling on_etf(etf_code, rows, dates) as each one finishes."""
+        etfs = [code for code in (self.file_map if etfs is None else etfs) if code in self.file_map]
+        results = {etf_code: [] for etf_code in etfs}  # keep file_map order
+        etf_dates = {}
+        compared_files = {}
+
+        async for etf_code, prep, rows in self.aiter_real_data(etfs):
+            results[etf_code] = rows
+            if prep is not None:
+                latest, previous = prep['latest'], prep['previous']
+                etf_dates[etf_code] = {"new": latest['date'], "old": previous['date']}
+                compared_files[etf_code] = [latest['id'], previous['id']]
+            if on_etf:
+                on_etf(etf_code, rows, etf_dates.get(etf_code))
+
+        dates_info = headline_dates({c: etf_dates[c] for c in etfs if c in etf_dates})
+
+        # Only the ETFs just compared are replaced (failed ones keep their files pinned);
+        # ETFs dropped from the registry are forgotten
+        self.compared_files = {
+            code: ids for code, ids in self.compared_files.items()
+            if code in self.file_map and code not in compared_files
+        }
+        self.compared_files.update(compared_files)
+
         # Clean up cache
-        self.cleanup_cache() 
+        await self._in_executor(self.cleanup_cache)
         return results, dates_info
 
-    def cleanup_cache(self, keep_count=20):
-        if not os.path.exists(CACHE_DIR):
-            return
+    def get_real_data(self):
+        return self._run_sync(self.aget_real_data())
 
-        all_files = [os.path.join(CACHE_DIR, f) for f in os.listdir(CACHE_DIR) if os.path.isfile(os.path.join(CACHE_DIR, f))]
-        
-        # Keep latest X files
-        all_files.sort(key=os.path.getmtime, reverse=True)
-        if len(all_files) > keep_count:
-            for trash in all_files[keep_count:]:
+    async def alatest_file_ids(self, etfs=None):
+        """Ids of the two newest dated files per ETF, as get_real_data would pick them."""
+        async def latest_two(folder_url):
+            try:
+                return [f['id'] for f in self.find_latest_two_files(await self.alist_folder_files(folder_url))]
+            except Exception as e:
+                print(f"[latest_file_ids] {folder_url}: {e}")
+                return []
+
+        etfs = [code for code in (self.file_map if etfs is None else etfs) if code in self.file_map]
+        listed = zip(etfs, await asyncio.gather(*(latest_two(self.file_map[code]) for code in etfs)))
+        return {etf_code: ids for etf_code, ids in listed if len(ids) >= 2}
+
+    # ---------------- Holdings History ----------------
+    def record_history(self, etf_code, file_info, path):
+        """Adds a downloaded file's holdings to the history store if that day is missing."""
+        if self.history.has(etf_code, file_info['date']):
+            return False
+        return self.history.append(etf_code, file_info['date'], self.load_holdings(path, file_info['id']))
+
+    async def abackfill_history(self, etfs=None):
+        """Downloads and stores the dated files of the ETFs that the history store lacks."""
+        slots = asyncio.Semaphore(HISTORY_BACKFILL_CONCURRENCY)
+
+        async def ingest(etf_code, file_info):
+            async with slots:
                 try:
-                    os.remove(trash)
-                except: pass
+                    path = await self.adownload_file(file_info, etf_code)
+                    await self._in_executor(self.record_history, etf_code, file_info, path)
+                    return 1
+                except Exception as e:
+                    print(f"[history] {etf_code} {file_info['name']}: {e}")
+                    return 0
 
-    def compare_files(self, path_old, path_latest, date_latest_str):
-        try:
-            def load_valid_sheet(path):
-                xl = pd.ExcelFile(path)
-                for sheet in xl.sheet_names:
-                    df_raw = pd.read_excel(path, sheet_name=sheet, header=None)
-                    idx = self.find_stock_header_index(df_raw)
-                    if idx is not None:
-                        return pd.read_excel(path, sheet_name=sheet, header=idx)
-                return None
+        jobs = []
+        for etf_code in (self.file_map if etfs is None else etfs):
+            if etf_code not in self.file_map:
+                continue
+            for file_info in self.find_dated_files(await self.alist_folder_files(self.file_map[etf_code])):
+                if not self.history.has(etf_code, file_info['date']):
+                    jobs.append(ingest(etf_code, file_info))
+        added = sum(await asyncio.gather(*jobs))
+        if added:
+            print(f"[history] Backfilled {added} ETF-day(s)")
+            await self._in_executor(self.cleanup_cache)
+        return added
 
-            df_old = load_valid_sheet(path_old)
-            df_latest = load_valid_sheet(path_latest)
+    async def adiff_history(self, etf_code, date_old, date_new, with_prices=True):
+        """Compares any two stored days of an ETF, in the same row format as get_real_data."""
+        old = self.history.holdings(etf_code, date_old)
+        new = self.history.holdings(etf_code, date_new)
+        if old is None or new is None:
+            missing = [d for d, h in ((date_old, old), (date_new, new)) if h is None]
+            return {"error": f"No stored holdings for {etf_code} on {missing}"}
 
-            if df_old is None or df_latest is None:
-                return {"error": "Excel format error: Header not found in any sheet"}
+        diff = HoldingsDiff(old, new)
+        prices = {}
+        if with_prices:
+            prices = await self.aget_stock_prices(self.codes_needing_price(diff), date_new)
+        return {"data": self.build_rows(diff, prices)}
 
-            df_old.columns = [str(c).strip() for c in df_old.columns]
-            df_latest.columns = [str(c).strip() for c in df_latest.columns]
+    def cleanup_cache(self):
+        """Applies the download cache's per-ETF retention and byte budget.
 
-            def find_col(df, candidates, exclude=None):
-                for c in df.columns:
-                    if exclude and any(ex in c for ex in exclude):
-                        continue
-                    if any(cand in c for cand in candidates):
-                        return c
-                return None
+        The files behind the current comparison are never evicted.
+        """
+        pinned = {fid for ids in self.compared_files.values() for fid in ids}
+        evicted = self.files.enforce(pinned=pinned)
+        if evicted:
+            stats = self.files.stats()
+            print(f"[cache] Evicted {evicted} file(s), keeping {stats['files']} ({stats['bytes'] / 1e6:.1f} MB)")
 
-            id_candidates = ['股票代號', '股票代碼', '證券代號', 'Code', 'Symbol', 'Ticker']
-            name_candidates = ['股票名稱', 'Name', 'Security Name', '證券名稱', '名稱', 'Security']
-            shares_candidates = ['股數', 'Shares', 'Volume', '持股', '持有股數', 'Units', 'Quantity']
-            
-            col_id_old = find_col(df_old, id_candidates)
-            col_id_new = find_col(df_latest, id_candidates)
-            col_name_old = find_col(df_old, name_candidates)
-            col_name_new = find_col(df_latest, name_candidates)
-            
-            weight_exclusions = ['權重', '%', 'Rate', 'Ratio', '比例']
-            col_shares_old = find_col(df_old, shares_candidates, exclude=weight_exclusions)
-            col_shares_new = find_col(df_latest, shares_candidates, exclude=weight_exclusions)
-            
-            if not all([col_id_old, col_id_new, col_shares_old, col_shares_new]):
-                missing = []
-                if not col_id_new: missing.append("Ticker")
-                if not col_shares_new: missing.append("Shares")
-                return {"error": f"Missing required columns. Missing: {missing}"}
-
-            df_old = df_old[[col_id_old, col_name_old, col_shares_old]].copy()
-            df_old.columns = ['股票代號', '股票名稱', '股數']
-            
-            col_weight = find_col(df_latest, ['持股權重', 'Weight', '持股權重(%)', '持股比例(%)'])
-            cols_needed_new = [col_id_new, col_name_new, col_shares_new]
-            if col_weight: cols_needed_new.append(col_weight)
-            
-            df_latest = df_latest[cols_needed_new].copy()
-            renames = {col_id_new: '股票代號', col_name_new: '股票名稱', col_shares_new: '股數'}
-            if col_weight: renames[col_weight] = '持股權重'
-            df_latest.rename(columns=renames, inplace=True)
+    def _remove_legacy_downloads(self):
+        """Drops workbooks left at the top of CACHE_DIR by the old name-keyed layout."""
+        for name in os.listdir(CACHE_DIR):
+            if name.lower().endswith((".xlsx", ".xls", ".part")):
+                try:
+                    os.remove(os.path.join(CACHE_DIR, name))
+                except OSError:
+                    pass
 
-            for df in [df_old, df_latest]:
-                df['股票代號'] = df['股票代號'].astype(str).str.strip().str.replace(r"\.0$", "", regex=True)
-                df['股票名稱'] = df['股票名稱'].astype(str).str.strip()
+    # ---------------- Holdings Parsing ----------------
+    def parse_holdings(self, path):
+        """Parses a holdings workbook into the canonical (ticker, name, shares, weight) table."""
+        df = self.read_holdings_table(path)
+        if df is None:
+            raise ValueError("Excel format error: Header not found in any sheet")
 
-            df_old = df_old.rename(columns={'股數': '股數_old', '股票名稱': '股票名稱_old'})
-            df_latest = df_latest.rename(columns={'股數': '股數_new', '股票名稱': '股票名稱_new'})
-            
-            merged = pd.merge(df_old, df_latest, on='股票代號', how='outer')
-            merged['股票名稱'] = merged['股票名稱_new'].combine_first(merged['股票名稱_old'])
-            
-            merged['股數_old'] = pd.to_numeric(merged['股數_old'].astype(str).str.replace(',', ''), errors='coerce').fillna(0)
-            merged['股數_new'] = pd.to_numeric(merged['股數_new'].astype(str).str.replace(',', ''), errors='coerce').fillna(0)
-            merged['delta_shares'] = merged['股數_new'] - merged['股數_old']
-
-            df_changes = merged[merged['delta_shares'] != 0].copy()
-            df_holdings = merged[merged['股數_new'] > 1000].copy()
-
-            def process_rows(df, is_change_list=True):
-                result = []
-                for _, row in df.iterrows():
-                    code = row['股票代號']
-                    price = self.get_stock_price(code, date_latest_str)
-                    
-                    base_share = row['delta_shares'] if is_change_list else row['股數_new']
-                    monetary = base_share * price
-                    
-                    action = "Changed"
-                    if is_change_list:
-                        if row['股數_old'] == 0: action = "Added"
-                        elif row['股數_new'] <= 1000: action = "Removed"
-                    else:
-                        action = "Holding"
-
-                    item = {
-                        "ticker": code,
-                        "name": row['股票名稱'],
-                        "old_shares": int(row['股數_old']),
-                        "new_shares": int(row['股數_new']),
-                        "delta_shares": int(row['delta_shares']),
-                        "price": price,
-                        "monetary_value": monetary,
-                        "monetary_value_str": self.format_twd_amount(monetary),
-                        "action": action
-                    }
-                    result.append(item)
-                return result
-
-            list_changes = process_rows(df_changes, is_change_list=True)
-            list_holdings = process_rows(df_holdings, is_change_list=False)
+        def find_col(candidates, exclude=None):
+            for c in df.columns:
+                if exclude and any(ex in c for ex in exclude):
+                    continue
+                if any(cand in c for cand in candidates):
+                    return c
+            return None
 
-            return {
-                "data": {
-                    "changes": list_changes,
-                    "holdings": list_holdings
-                }
-            }
+        col_id = find_col(['股票代號', '股票代碼', '證券代號', 'Code', 'Symbol', 'Ticker'])
+        col_name = find_col(['股票名稱', 'Name', 'Security Name', '證券名稱', '名稱', 'Security'])
+        col_shares = find_col(['股數', 'Shares', 'Volume', '持股', '持有股數', 'Units', 'Quantity'],
+                              exclude=['權重', '%', 'Rate', 'Ratio', '比例'])
+        col_weight = find_col(['持股權重', 'Weight', '持股權重(%)', '持股比例(%)'])
+
+        if not col_id or not col_shares:
+            missing = []
+            if not col_id: missing.append("Ticker")
+            if not col_shares: missing.append("Shares")
+            raise ValueError(f"Missing required columns. Missing: {missing}")
 
+        def to_number(col):
+            text = df[col].astype(str).str.strip().str.rstrip('%').str.replace(',', '')
+            return pd.to_numeric(text, errors='coerce')
+
+        return pd.DataFrame({
+            "ticker": df[col_id].astype(str).str.strip().str.replace(r"\.0$", "", regex=True),
+            "name": df[col_name].astype(str).str.strip() if col_name else "",
+            "shares": to_number(col_shares).fillna(0),
+            "weight": to_number(col_weight) if col_weight else float("nan"),
+        })
+
+    def load_holdings(self, path, file_id=None):
+        """Compact Holdings for a downloaded file, parsed once and kept as Parquet.
+
+        The Parquet copy is keyed by Drive file id plus content hash, so a
+        re-uploaded file under the same id is parsed again.
+        """
+        entry = self.files.get(file_id) if file_id else None
+        if entry is not None and entry['path'] == path:
+            digest = entry['sha1']
+        else:
+            h = hashlib.sha1()
+            with open(path, "rb") as fh:
+                for block in iter(lambda: fh.read(1 << 20), b""):
+                    h.update(block)
+            digest = h.hexdigest()
+        key = f"{file_id or os.path.basename(path)}-{digest[:16]}"
+        parsed_path = os.path.join(PARSED_DIR, f"{key}.parquet")
+
+        if os.path.exists(parsed_path):
+            try:
+                holdings = Holdings.read_parquet(parsed_path)
+                metrics.inc("parsed_cache_total", result="hit")
+                if file_id:
+                    self.files.add_derived(file_id, parsed_path)
+                return holdings
+            except Exception as e:
+                print(f"[parsed cache] {parsed_path} unreadable, re-parsing: {e}")
+
+        metrics.inc("parsed_cache_total", result="miss")
+        with metrics.timer("parse", detail=os.path.basename(path)):
+            df = self.parse_holdings(path)
+        os.makedirs(PARSED_DIR, exist_ok=True)
+        tmp_path = f"{parsed_path}.tmp"
+        df.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, parsed_path)
+        if file_id:
+            self.files.add_derived(file_id, parsed_path)
+        return Holdings.from_frame(df)
+
+    def merge_holdings(self, path_old, path_latest, fid_old=None, fid_latest=None):
+        """Loads both holdings files and outer-joins them on ticker with share deltas."""
+        try:
+            old = self.load_holdings(path_old, fid_old)
+            latest = self.load_holdings(path_latest, fid_latest)
+            with metrics.timer("merge"):
+                return {"merged": HoldingsDiff(old, latest)}
+
+        except ValueError as e:
+            return {"error": str(e)}
+        except Exception as e:
+            print(traceback.format_exc())
+            return {"error": str(e)}
+
+    def codes_needing_price(self, diff):
+        """Tickers that show up in either the change list or the holdings list."""
+        mask = (diff.delta_shares != 0) | (diff.new_shares > 1000)
+        return ticker_table.lookup(diff.ids[mask]).tolist()
+
+    def build_rows(self, diff, prices):
+        """Change and holding rows for the API, computed column-wise over the diff arrays.
+
+        Rows come out in ticker order, as the old pandas outer merge returned them.
+        """
+        tickers = ticker_table.lookup(diff.ids)
+        order = np.argsort(tickers.astype(str), kind="stable")
+        price = np.array([prices.get(t) for t in tickers.tolist()], dtype=float)
+        price[np.isnan(price)] = 0
+        old_shares, new_shares = diff.old_shares, diff.new_shares
+        delta = diff.delta_shares
+
+        def emit(mask, base_share, action):
+            idx = order[mask[order]]
+            monetary = base_share[idx] * price[idx]
+            columns = (
+                tickers[idx].tolist(),
+                diff.names[idx].tolist(),
+                old_shares[idx].astype(np.int64).tolist(),
+                new_shares[idx].astype(np.int64).tolist(),
+                delta[idx].astype(np.int64).tolist(),
+                price[idx].tolist(),
+                monetary.tolist(),
+                self.format_twd_amounts(monetary),
+                [ROW_ACTIONS[a] for a in action[idx].tolist()] if isinstance(action, np.ndarray) else [action] * len(idx),
+            )
+            # One pass over native Python lists; tickers, names and actions are shared strings
+            return [HoldingRow(*values) for values in zip(*columns)]
+
+        change_action = np.select([old_shares == 0, new_shares <= 1000], [0, 1], default=2)
+        return {
+            "changes": emit(delta != 0, delta, change_action),
+            "holdings": emit(new_shares > 1000, new_shares, "Holding")
+        }
+
+    def compare_files(self, path_old, path_latest, date_latest_str):
+        merge_result = self.merge_holdings(path_old, path_latest)
+        if "error" in merge_result:
+            return merge_result
+        merged = merge_result['merged']
+        try:
+            prices = self.get_stock_prices(self.codes_needing_price(merged), date_latest_str)
+            return {"data": self.build_rows(merged, prices)}
         except Exception as e:
-            import traceback
             print(traceback.format_exc())
             return {"error": str(e)}
 
-processor = ETFProcessor()
+processor = None  # the shared ETFProcessor, see get_processor()
+_processor_lock = threading.Lock()
+
+def get_processor():
+    """The shared ETFProcessor, created on first use instead of at import time."""
+    global processor
+    if processor is None:
+        with _processor_lock:
+            if processor is None:
+                processor = ETFProcessor()
+    return processor
+
+def warm_up():
+    """Creates the processor and imports the heavy libraries; run off the event loop at startup."""
+    get_processor()
+    for module in (np, pd, yf, bs4, openpyxl, pyarrow, parquet):
+        module.load()
 
 def cleanup_real_cache():
     # Deprecated fallback, handled in class now
     pass
 
+FLOW_COLUMNS = ["etf", "ticker", "name", "old_shares", "new_shares", "delta_shares", "monetary_value", "action"]
+FLOW_SORT_KEYS = {"monetary_value", "delta_shares", "old_shares", "new_shares", "ticker", "name",
+                  "etf_count", "buy_etfs", "sell_etfs"}
+
+def build_flows(data):
+    """Cross-ETF view of one snapshot's changes.
+
+    Returns the long (etf, ticker) change table, the ETF x ticker matrices of
+    delta shares and monetary flow, and one net row per ticker in the same
+    shape the frontend uses for its aggregated table.
+    """
+    records = [
+        {"etf": etf_code, **{k: row[k] for k in FLOW_COLUMNS[1:]}}
+        for etf_code, etf_data in data.items() if etf_data
+        for row in etf_data.get('changes', [])
+    ]
+    long = pd.DataFrame.from_records(records, columns=FLOW_COLUMNS)
+    delta_matrix = long.pivot_table(index='ticker', columns='etf', values='delta_shares', aggfunc='sum', fill_value=0)
+    value_matrix = long.pivot_table(index='ticker', columns='etf', values='monetary_value', aggfunc='sum', fill_value=0)
+
+    tickers = long.groupby('ticker', sort=False).agg(
+        name=('name', 'first'),
+        old_shares=('old_shares', 'sum'),
+        new_shares=('new_shares', 'sum'),
+        delta_shares=('delta_shares', 'sum'),
+        monetary_value=('monetary_value', 'sum'),
+    )
+    moved = delta_matrix.reindex(tickers.index)
+    tickers['buy_etfs'] = (moved > 0).sum(axis=1)
+    tickers['sell_etfs'] = (moved < 0).sum(axis=1)
+    tickers['etf_count'] = tickers['buy_etfs'] + tickers['sell_etfs']
+    etf_names = moved.columns.to_numpy()
+    deltas = moved.to_numpy()
+    tickers['affected_etfs'] = [etf_names[row != 0].tolist() for row in deltas]
+    tickers['etf_deltas'] = [dict(zip(etf_names[row != 0].tolist(), row[row != 0].tolist())) for row in deltas]
+    tickers = tickers[tickers['delta_shares'] != 0].reset_index()
+    tickers['monetary_value_str'] = get_processor().format_twd_amounts(tickers['monetary_value'])
+
+    return {"long": long, "delta_shares": delta_matrix, "monetary_value": value_matrix, "tickers": tickers}
+
+def headline_dates(etf_dates):
+    """Dates block of a snapshot: per-ETF dates plus the newest comparison, first ETF in order on ties."""
+    dates_info = {"new": "", "old": "", "etfs": etf_dates}
+    if etf_dates:
+        dates_info.update(max(etf_dates.values(), key=lambda d: d["new"]))
+    return dates_info
+
+def summarize(flows):
+    processor = get_processor()
+    changes = flows["long"]
+    value = changes['monetary_value']
+    net_value = flows["tickers"]['monetary_value']
+    return {
+        "total_value_change": processor.format_twd_amount(value.sum()),
+        "total_buy_str": processor.format_twd_amount(net_value[net_value > 0].sum()),
+        "total_sell_str": processor.format_twd_amount(net_value[net_value < 0].sum()),
+        "count_added": int((changes['action'] == "Added").sum()),
+        "count_removed": int((changes['action'] == "Removed").sum())
+    }
+
+async def build_etfs(etfs, on_etf=None):
+    """Runs the full pipeline for some ETFs; returns their rows, dates, compared files, failures and the trace."""
+    processor = get_processor()
+    trace = metrics.start_trace()
+    try:
+        with metrics.timer("refresh"):
+            data, dates = await processor.aget_real_data(on_etf, etfs)
+    except Exception:
+        metrics.inc("refreshes_total", result="error")
+        raise
+    metrics.inc("refreshes_total", result="ok")
+    files = {code: processor.compared_files[code] for code in data if code in processor.compared_files}
+    # ETFs that produced no comparison (listing, download or parse failed, or too few files)
+    failed = [code for code in data if code not in dates["etfs"]]
+    return {"etf_details": data, "etf_dates": dates["etfs"], "files": files, "failed": failed,
+            "trace": metrics.finish_trace(trace)}
+
+def kept_on_failure(snapshot, part):
+    """ETFs whose rebuild in part failed but which have earlier data in snapshot."""
+    previous = snapshot["etf_details"] if snapshot else {}
+    return {code for code in part.get("failed", ()) if code in previous}
+
+def merge_snapshot(snapshot, part):
+    """The snapshot served by /api/holdings/changes, with the ETFs of part rebuilt and the rest kept.
+
+    ETFs come out in registry order; ETFs no longer registered are dropped.
+    ETFs of part that failed keep their previous rows, dates and files.
+    Flows and the summary are recomputed over every ETF.
+    """
+    order = get_processor().file_map
+    previous = snapshot or {"etf_details": {}, "dates": {"etfs": {}}, "files": {}}
+    kept = kept_on_failure(previous, part)
+    rebuilt = {code: rows for code, rows in part["etf_details"].items() if code not in kept}
+
+    def combine(old, new):
+        merged = {code: value for code, value in old.items() if code not in rebuilt}
+        merged.update((code, value) for code, value in new.items() if code not in kept)
+        return {code: merged[code] for code in order if code in merged}
+
+    data = combine(previous["etf_details"], rebuilt)
+    with metrics.timer("flows"):
+        flows = build_flows(data)
+    return {
+        "dates": headline_dates(combine(previous["dates"]["etfs"], part["etf_dates"])),
+        "summary": summarize(flows),
+        "etf_details": data,
+        "built_at": datetime.now().isoformat(timespec="seconds"),
+        "files": combine(previous["files"], part["files"]),
+        "trace": part["trace"],
+        "_flows": flows
+    }
+
+def public_snapshot(snapshot, etfs=None):
+    """The snapshot without its precomputed internals (keys starting with '_').
+
+    With etfs, only those ETFs are kept and the dates and summary cover just them.
+    """
+    public = {k: v for k, v in snapshot.items() if not k.startswith("_")}
+    if etfs:
+        data = {code: snapshot["etf_details"].get(code, []) for code in etfs}
+        etf_dates = snapshot["dates"]["etfs"]
+        public.update(
+            etf_details=data,
+            dates=headline_dates({code: etf_dates[code] for code in etfs if code in etf_dates}),
+            summary=summarize(build_flows(data)),
+            files={code: ids for code, ids in snapshot["files"].items() if code in data},
+        )
+    return public
+
+def select_rows(rows, fields=None):
+    """Keeps only the requested fields of each row; all fields when fields is empty."""
+    if not fields:
+        return rows
+    return [{f: row[f] for f in fields if f in row} for row in rows]
+
+def parse_fields(fields):
+    return [f.strip() for f in fields.split(",") if f.strip()] if fields else None
+
+def parse_etfs(etf):
+    """Registered ETF codes from an etf=A,B query parameter, or None for all of them.
+
+    Raises ValueError naming any code that is not in the registry.
+    """
+    codes = parse_fields(etf)
+    if not codes:
+        return None
+    unknown = [code for code in codes if code not in get_processor().file_map]
+    if unknown:
+        raise ValueError(f"Unknown ETF {', '.join(map(repr, unknown))}")
+    return list(dict.fromkeys(codes))
+
+class SnapshotScheduler:
+    """Rebuilds ETFs in the background and serves the latest snapshot.
+
+    ETFs are rebuilt on their own schedule: when their registry cadence has
+    elapsed, as soon as new Drive files show up for hot (high-priority) ones,
+    and on demand when a client asks for one that was never built. Each
+    rebuild is merged into the snapshot, which covers every ETF built so far.
+    """
+
+    def __init__(self, build):
+        self.build = build
+        self.snapshot = None
+        self.built = {}  # etf -> time.monotonic() of its last rebuild
+        self._inflight = {}  # etf -> (task, progress) of the rebuild covering it
+        self._task = None
+        self._backfill = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        for task in (self._task, self._backfill):
+            if task:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+
+    def _etfs(self, etfs=None):
+        return get_processor().etfs_by_priority(etfs)
+
+    def _stale(self, etf_code, now):
+        """True if etf_code was never built or its last build is older than its refresh interval.
+
+        On-demand ETFs (refresh_interval 0) age out after REFRESH_INTERVAL.
+        """
+        built = self.built.get(etf_code)
+        interval = get_processor().etf_entry(etf_code)["refresh_interval"] or REFRESH_INTERVAL
+        return built is None or now - built >= interval
+
+    def _on_request(self, etfs):
+        """ETFs a client request has to build first: never built, or on-demand and stale."""
+        processor, now = get_processor(), time.monotonic()
+        return [etf for etf in etfs if etf not in self.built
+                or not processor.etf_entry(etf)["refresh_interval"] and self._stale(etf, now)]
+
+    def _ensure_rebuild(self, etfs):
+        """Starts one rebuild for the ETFs not already in one; returns the (task, progress) pairs covering etfs."""
+        todo = [etf for etf in etfs if etf not in self._inflight]
+        if todo:
+            # Per-ETF results of this rebuild, for streaming readers
+            progress = {"items": [], "changed": asyncio.Event()}
+            task = asyncio.create_task(self._rebuild(todo, progress))
+            for etf in todo:
+                self._inflight[etf] = (task, progress)
+        return list({id(task): (task, progress) for task, progress in map(self._inflight.get, etfs)}.values())
+
+    async def refresh(self, etfs=None):
+        """Rebuilds etfs (all of them when None) now.
+
+        Callers asking for an ETF that is already being rebuilt wait on that
+        rebuild instead of starting another one.
+        """
+        tasks = [task for task, _ in self._ensure_rebuild(self._etfs(etfs))]
+        if tasks:
+            await asyncio.shield(asyncio.gather(*tasks))
+        elif self.snapshot is None:
+            self.snapshot = merge_snapshot(None, {"etf_details": {}, "etf_dates": {}, "files": {}, "trace": None})
+        return self.snapshot
+
+    async def events(self, refresh=False, etfs=None):
+        """Yields ("etf", code, rows, dates) per ETF, then ("snapshot", snapshot).
+
+        ETFs that need no build (all of them when refresh is asked for) are
+        replayed from the snapshot at once; the others are yielded as the
+        rebuild covering them finishes them.
+        """
+        etfs = self._etfs(etfs)
+        todo = list(etfs) if refresh else self._on_request(etfs)
+        snapshot = self.snapshot
+        for etf_code in etfs:
+            if etf_code not in todo:
+                yield "etf", etf_code, snapshot["etf_details"].get(etf_code, []), snapshot["dates"]["etfs"].get(etf_code)
+        if not todo:
+            yield "snapshot", snapshot if snapshot is not None else await self.refresh([])
+            return
+
+        wanted = set(todo)
+        rebuilds = self._ensure_rebuild(todo)
+        tasks = [task for task, _ in rebuilds]
+        seen = [0] * len(rebuilds)
+        while True:
+            waiters = [asyncio.ensure_future(progress["changed"].wait()) for _, progress in rebuilds]
+            for i, (_, progress) in enumerate(rebuilds):
+                while seen[i] < len(progress["items"]):
+                    item = progress["items"][seen[i]]
+                    seen[i] += 1
+                    if item[0] in wanted:
+                        yield ("etf", *item)
+            if all(task.done() for task in tasks):
+                for waiter in waiters:
+                    waiter.cancel()
+                break
+            await asyncio.wait({*waiters, *tasks}, return_when=asyncio.FIRST_COMPLETED)
+            for waiter in waiters:
+                waiter.cancel()
+        for task in tasks:
+            task.result()
+        yield "snapshot", self.snapshot
+
+    async def get(self, etfs=None):
+        """The snapshot, first building the ETFs of etfs that _on_request picks."""
+        missing = self._on_request(self._etfs(etfs))
+        if missing or self.snapshot is None:
+            return await self.refresh(missing)
+        return self.snapshot
+
+    async def _rebuild(self, etfs, progress):
+        def on_etf(etf_code, rows, dates):
+            if dates is None and self.snapshot and etf_code in self.snapshot["etf_details"]:
+                # Failed rebuild: readers get the last good rows, as the merge keeps them
+                rows, dates = self.snapshot["etf_details"][etf_code], self.snapshot["dates"]["etfs"].get(etf_code)
+            progress["items"].append((etf_code, rows, dates))
+            # Wake current readers, later ones wait on a fresh event
+            changed, progress["changed"] = progress["changed"], asyncio.Event()
+            changed.set()
+
+        try:
+            part = await self.build(etfs, on_etf)
+        finally:
+            for etf in etfs:
+                if self._inflight.get(etf, (None,))[0] is asyncio.current_task():
+                    del self._inflight[etf]
+        # Merged without awaiting in between: readers never see a partial
+        # merge and concurrent rebuilds of other ETFs are not lost
+        kept = kept_on_failure(self.snapshot, part)
+        self.snapshot = merge_snapshot(self.snapshot, part)
+        now = time.monotonic()
+        # ETFs that kept old data keep their old build time, so they are retried when due
+        for etf in etfs:
+            if etf not in kept:
+                self.built[etf] = now
+        self._start_backfill()
+        return self.snapshot
+
+    def _start_backfill(self):
+        """History backfill runs after each rebuild, never delaying the snapshot itself."""
+        if self._backfill is None or self._backfill.done():
+            self._backfill = asyncio.create_task(self._run_backfill())
+
+    async def _run_backfill(self):
+        try:
+            await get_processor().abackfill_history(list(self.built))
+        except Exception:
+            traceback.print_exc()
+
+    async def _due(self):
+        """ETFs to rebuild on this poll, most important first.
+
+        An ETF is due when its refresh_interval has elapsed (ETFs with no
+        interval are only built on request), or, for hot ETFs, when its two
+        newest Drive files changed.
+        """
+        processor = get_processor()
+        await asyncio.to_thread(processor.reload_registry)
+        now = time.monotonic()
+        due, hot = set(), []
+        for etf_code in processor.etfs_by_priority():
+            entry = processor.etf_entry(etf_code)
+            interval = entry["refresh_interval"]
+            if etf_code not in self.built:
+                if interval:
+                    due.add(etf_code)
+            elif interval and now - self.built[etf_code] >= interval:
+                due.add(etf_code)
+            elif entry["priority"] <= ETF_HOT_PRIORITY:
+                hot.append(etf_code)
+
+        if hot and self.snapshot is not None:
+            # Folders that failed to list are ignored rather than treated as changed
+            known = self.snapshot.get("files", {})
+            changed = [etf for etf, ids in (await processor.alatest_file_ids(hot)).items() if ids != known.get(etf)]
+            if changed:
+                print(f"New Drive files for {', '.join(changed)}, rebuilding...")
+                due.update(changed)
+        return [etf for etf in processor.etfs_by_priority() if etf in due]
+
+    async def _run(self):
+        # Startup returns right away; the processor and the heavy imports come
+        # up here, in a thread, so health checks are answered meanwhile
+        await asyncio.to_thread(warm_up)
+        while True:
+            try:
+                due = await self._due()
+                if due:
+                    await self.refresh(due)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                traceback.print_exc()
+            await asyncio.sleep(DRIVE_POLL_INTERVAL)
+
+    def status(self):
+        """Per-ETF registry settings and freshness, for /api/etfs."""
+        processor = get_processor()
+        now = time.monotonic()
+        rows = []
+        for etf_code in processor.etfs_by_priority():
+            entry = processor.etf_entry(etf_code)
+            built = self.built.get(etf_code)
+            age = now - built if built is not None else None
+            rows.append({
+                "etf": etf_code,
+                "priority": entry["priority"],
+                "refresh_interval": entry["refresh_interval"],
+                "refreshing": etf_code in self._inflight,
+                "age_seconds": round(age, 1) if age is not None else None,
+                "stale": self._stale(etf_code, now),
+                "dates": self.snapshot["dates"]["etfs"].get(etf_code) if self.snapshot else None,
+            })
+        return rows
+
+scheduler = SnapshotScheduler(build_etfs)
+
 @app.get("/api/holdings/changes")
-def get_holding_changes():
+async def get_holding_changes(etf: str = None):
+    """The snapshot of every ETF, or with etf=A,B just those (building only them if needed)."""
     try:
-        data, dates = processor.get_real_data()
-        
-        # Calculate aggregate changes
-        summary = {
-            "total_value_change": 0,
-            "count_added": 0,
-            "count_removed": 0
-        }
-        
-        for etf_code, etf_data in data.items():
-            if not etf_data: continue
-            
-            # Access 'changes' list safely
-            changes = etf_data.get('changes', []) if isinstance(etf_data, dict) else []
-            
-            for item in changes:
-                summary["total_value_change"] += item["monetary_value"]
-                if item["action"] == "Added":
-                    summary["count_added"] += 1
-                elif item["action"] == "Removed":
-                    summary["count_removed"] += 1
-                    
-        return {
-            "dates": dates,
-            "summary": {
-                "total_value_change": processor.format_twd_amount(summary["total_value_change"]),
-                "count_added": summary["count_added"],
-                "count_removed": summary["count_removed"]
-            },
-            "etf_details": data
-        }
+        etfs = parse_etfs(etf)
+    except ValueError as e:
+        return {"error": str(e)}
+    try:
+        return public_snapshot(await scheduler.get(etfs), etfs)
+    except Exception as e:
+        traceback.print_exc()
+        return {"error": str(e)}
+
+@app.get("/api/holdings/changes/stream")
+async def stream_holding_changes(kind: str = "all", fields: str = None, refresh: bool = False, etf: str = None):
+    """NDJSON: one {"type": "etf"} line per ETF as it becomes ready, then a {"type": "summary"} line.
+
+    kind=changes or kind=holdings drops the other list; fields=a,b,c keeps only those row fields;
+    etf=A,B streams only those ETFs.
+    """
+    kinds = ["changes", "holdings"] if kind == "all" else [kind]
+    field_list = parse_fields(fields)
+    try:
+        etfs = parse_etfs(etf)
+    except ValueError as e:
+        return {"error": str(e)}
+
+    async def lines():
+        try:
+            async for event in scheduler.events(refresh, etfs):
+                if event[0] == "etf":
+                    _, etf_code, etf_data, dates = event
+                    line = {"type": "etf", "etf": etf_code, "dates": dates}
+                    for k in kinds:
+                        line[k] = select_rows(etf_data.get(k, []) if etf_data else [], field_list)
+                else:
+                    snapshot = public_snapshot(event[1], etfs)
+                    line = {"type": "summary", **{k: snapshot[k] for k in ("dates", "summary", "built_at")}}
+                yield json.dumps(line, ensure_ascii=False, default=dict) + "\n"
+        except Exception as e:
+            traceback.print_exc()
+            yield json.dumps({"type": "error", "error": str(e)}, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+@app.get("/api/holdings/etf/{etf}")
+async def get_etf_rows(etf: str, kind: str = "changes", fields: str = None, offset: int = 0, limit: int = 100,
+                       sort: str = None, order: str = "desc"):
+    """One ETF's change or holding rows, paginated and with only the requested fields."""
+    if kind not in ("changes", "holdings"):
+        return {"error": f"Unknown kind {kind!r}, expected 'changes' or 'holdings'"}
+    if etf not in get_processor().file_map:
+        return {"error": f"Unknown ETF {etf!r}"}
+    try:
+        snapshot = await scheduler.get([etf])
+    except Exception as e:
+        traceback.print_exc()
+        return {"error": str(e)}
+
+    etf_data = snapshot["etf_details"][etf]
+    rows = etf_data.get(kind, []) if etf_data else []
+    if sort:
+        if rows and sort not in rows[0]:
+            return {"error": f"Unknown sort field {sort!r}"}
+        rows = sorted(rows, key=lambda r: r[sort], reverse=(order == "desc"))
+    offset = max(offset, 0)
+    limit = min(max(limit, 1), 5000)
+    return {
+        "etf": etf,
+        "kind": kind,
+        "dates": snapshot["dates"]["etfs"].get(etf),
+        "total": len(rows),
+        "offset": offset,
+        "limit": limit,
+        "rows": select_rows(rows[offset:offset + limit], parse_fields(fields))
+    }
+
+@app.post("/api/holdings/refresh")
+async def refresh_holding_changes(etf: str = None):
+    """Rebuilds every ETF now, or with etf=A,B just those."""
+    try:
+        etfs = parse_etfs(etf)
+    except ValueError as e:
+        return {"error": str(e)}
+    try:
+        return public_snapshot(await scheduler.refresh(etfs), etfs)
+    except Exception as e:
+        traceback.print_exc()
+        return {"error": str(e)}
+
+@app.get("/api/holdings/aggregate")
+async def get_aggregate_flows(sort: str = "monetary_value", order: str = "desc", top: int = None,
+                              direction: str = "all", min_etfs: int = 1, etf: str = None):
+    """Net per-ticker flows across all ETFs, filtered, sorted and cut on the server.
+
+    Sort keys without a per-ticker column (the frontend shares one sort
+    setting across tabs) fall back to monetary_value.
+    """
+    if sort not in FLOW_SORT_KEYS:
+        sort = "monetary_value"
+    try:
+        snapshot = await scheduler.get()
+    except Exception as e:
+        traceback.print_exc()
+        return {"error": str(e)}
+
+    rows = snapshot["_flows"]["tickers"]
+    mask = rows['etf_count'] >= min_etfs
+    if direction == "buy":
+        mask &= rows['delta_shares'] > 0
+    elif direction == "sell":
+        mask &= rows['delta_shares'] < 0
+    if etf:
+        mask &= rows['affected_etfs'].map(lambda etfs: etf in etfs)
+    rows = rows[mask].sort_values(sort, ascending=(order == "asc"), kind="stable")
+
+    return {
+        "dates": snapshot["dates"],
+        "built_at": snapshot["built_at"],
+        "total": len(rows),
+        "rows": rows.head(top).to_dict('records') if top else rows.to_dict('records')
+    }
+
+@app.get("/api/history/{etf}/dates")
+def get_history_dates(etf: str):
+    return {"etf": etf, "dates": get_processor().history.dates(etf)}
+
+@app.get("/api/history/{etf}/diff")
+async def get_history_diff(etf: str, start: str, end: str, prices: bool = True):
+    try:
+        result = await get_processor().adiff_history(etf, start, end, with_prices=prices)
+        if "error" in result:
+            return result
+        return {"etf": etf, "dates": {"old": start, "new": end}, **result["data"]}
     except Exception as e:
-        import traceback
         traceback.print_exc()
         return {"error": str(e)}
 
+@app.get("/api/history/ticker/{ticker}")
+def get_ticker_history(ticker: str, start: str = None, end: str = None, etf: str = None):
+    rows = get_processor().history.ticker_history(ticker, start, end, etf)
+    rows = rows.astype(object).where(rows.notna(), None)  # NaN weights -> null
+    return {"ticker": ticker, "history": rows.to_dict('records')}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    """Prometheus scrape endpoint: pipeline counters, stage timings and cache gauges."""
+    snapshot = scheduler.snapshot
+    gauges = [("uptime_seconds", {}, round(time.monotonic() - STARTED_AT, 3))]
+    if snapshot is not None and snapshot["trace"]:
+        gauges.append(("last_refresh_seconds", {}, snapshot["trace"]["total_seconds"]))
+    gauges.append(("etfs_built", {}, len(scheduler.built)))
+    if processor is None:  # still starting up; a scrape should not build it
+        return PlainTextResponse(metrics.render(gauges), media_type="text/plain; version=0.0.4")
+    price_stats = processor.price_cache.stats()
+    file_stats = processor.files.stats()
+    gauges += [
+        ("price_cache_hits", {"tier": "any"}, price_stats["hits"]),
+        ("price_cache_hits", {"tier": "disk"}, price_stats["disk_hits"]),
+        ("price_cache_misses", {}, price_stats["misses"]),
+        ("price_cache_hit_ratio", {}, price_stats["hit_rate"]),
+        ("price_cache_memory_items", {}, price_stats["memory_items"]),
+        ("file_cache_files", {}, file_stats["files"]),
+        ("file_cache_bytes", {}, file_stats["bytes"]),
+        ("file_cache_evictions", {}, file_stats["evictions"]),
+    ]
+    gauges.append(("etfs_registered", {}, len(processor.file_map)))
+    limiter = processor.http.limiter_stats()
+    gauges += [("provider_rate_limit", {"provider": name}, rate) for name, rate in limiter["rates"].items()]
+    breakers = {**limiter["breakers"], "yfinance": processor.yf_breaker.state}
+    gauges += [("breaker_open", {"provider": name}, int(state != "closed")) for name, state in breakers.items()]
+    return PlainTextResponse(metrics.render(gauges), media_type="text/plain; version=0.0.4")
+
+@app.get("/api/etfs")
+def get_etfs():
+    """The ETF registry with each fund's priority, cadence and freshness."""
+    return {"registry": ETF_REGISTRY, "etfs": scheduler.status()}
+
+@app.get("/api/cache/stats")
+def get_cache_stats():
+    processor = get_processor()
+    return {"prices": processor.price_cache.stats(), "files": processor.files.stats()}
+
+@app.get("/api/health")
+def get_health():
+    """Liveness/readiness probe; answers from the first second, before any refresh has finished."""
+    snapshot = scheduler.snapshot
+    return {
+        "status": "ok",
+        "ready": snapshot is not None,
+        "built_at": snapshot["built_at"] if snapshot else None,
+        "uptime_seconds": round(time.monotonic() - STARTED_AT, 3),
+    }
+
 if __name__ == "__main__":
+    import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,155 @@
+"""Micro-benchmark for the comparison stage (merge + row building).
+
+Generates two synthetic holdings workbooks, parses them once, then times the
+old pandas outer merge and per-row implementation against HoldingsDiff plus
+ETFProcessor.build_rows, checks that both produce the same rows, and reports
+the memory each comparison keeps alive.
+
+    python benchmarks/bench_compare.py --rows 5000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+# Run from the repo root like start.py does
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from backend.main import ETFProcessor, Holdings, HoldingsDiff
+
+
+def write_holdings(path, n_rows, seed):
+    rng = np.random.default_rng(seed)
+    codes = [str(1101 + i) for i in range(n_rows)]
+    shares = rng.integers(0, 5_000, size=n_rows) * 1000
+    df = pd.DataFrame({
+        "股票代號": codes,
+        "股票名稱": [f"股票{c}" for c in codes],
+        "股數": [f"{s:,}" for s in shares],
+        "持股權重(%)": rng.random(n_rows).round(2),
+    })
+    with pd.ExcelWriter(path) as writer:
+        pd.DataFrame([["基金名稱", "Synthetic"], ["日期", "2026/01/05"]]).to_excel(
+            writer, sheet_name="持股", header=False, index=False)
+        df.to_excel(writer, sheet_name="持股", startrow=3, index=False)
+
+
+def legacy_merge_frames(df_old, df_latest):
+    """The DataFrame outer merge HoldingsDiff replaced."""
+    df_old = df_old[['ticker', 'name', 'shares']].rename(
+        columns={'ticker': '股票代號', 'name': '股票名稱_old', 'shares': '股數_old'})
+    df_latest = df_latest[['ticker', 'name', 'shares']].rename(
+        columns={'ticker': '股票代號', 'name': '股票名稱_new', 'shares': '股數_new'})
+    merged = pd.merge(df_old, df_latest, on='股票代號', how='outer')
+    merged['股票名稱'] = merged['股票名稱_new'].combine_first(merged['股票名稱_old'])
+    merged['股數_old'] = merged['股數_old'].fillna(0)
+    merged['股數_new'] = merged['股數_new'].fillna(0)
+    merged['delta_shares'] = merged['股數_new'] - merged['股數_old']
+    return merged
+
+
+def legacy_build_rows(processor, merged, prices):
+    """The iterrows implementation build_rows replaced, kept here as the baseline."""
+    df_changes = merged[merged['delta_shares'] != 0].copy()
+    df_holdings = merged[merged['股數_new'] > 1000].copy()
+
+    def process_rows(df, is_change_list=True):
+        result = []
+        for _, row in df.iterrows():
+            code = row['股票代號']
+            price = prices.get(code, 0)
+            base_share = row['delta_shares'] if is_change_list else row['股數_new']
+            monetary = base_share * price
+            action = "Changed"
+            if is_change_list:
+                if row['股數_old'] == 0: action = "Added"
+                elif row['股數_new'] <= 1000: action = "Removed"
+            else:
+                action = "Holding"
+            result.append({
+                "ticker": code,
+                "name": row['股票名稱'],
+                "old_shares": int(row['股數_old']),
+                "new_shares": int(row['股數_new']),
+                "delta_shares": int(row['delta_shares']),
+                "price": price,
+                "monetary_value": monetary,
+                "monetary_value_str": processor.format_twd_amount(monetary),
+                "action": action
+            })
+        return result
+
+    return {
+        "changes": process_rows(df_changes, is_change_list=True),
+        "holdings": process_rows(df_holdings, is_change_list=False)
+    }
+
+
+def best_of(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def retained_kb(fn):
+    """Bytes still allocated by fn's result once it returns, in KiB."""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = fn()
+    retained = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del result
+    return retained / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    processor = ETFProcessor()
+    with tempfile.TemporaryDirectory() as tmp:
+        path_old, path_new = os.path.join(tmp, "old.xlsx"), os.path.join(tmp, "new.xlsx")
+        write_holdings(path_old, args.rows, seed=1)
+        write_holdings(path_new, args.rows, seed=2)
+        df_old = processor.parse_holdings(path_old)
+        df_new = processor.parse_holdings(path_new)
+
+    rng = np.random.default_rng(0)
+    prices = {code: float(p) for code, p in zip(df_new["ticker"], rng.uniform(10, 1000, len(df_new)).round(2))}
+
+    h_old, h_new = Holdings.from_frame(df_old), Holdings.from_frame(df_new)
+
+    t_merge, merged = best_of(lambda: legacy_merge_frames(df_old, df_new), args.repeat)
+    t_legacy, legacy = best_of(lambda: legacy_build_rows(processor, merged, prices), args.repeat)
+    t_diff, diff = best_of(lambda: HoldingsDiff(h_old, h_new), args.repeat)
+    t_vector, vector = best_of(lambda: processor.build_rows(diff, prices), args.repeat)
+
+    as_dicts = {kind: [row.to_dict() for row in rows] for kind, rows in vector.items()}
+    assert legacy == as_dicts, "array rows differ from the legacy implementation"
+
+    legacy_kb = retained_kb(lambda: (lambda m: (m, legacy_build_rows(processor, m, prices)))(
+        legacy_merge_frames(df_old, df_new)))
+    compact_kb = retained_kb(lambda: (lambda d: (d, processor.build_rows(d, prices)))(HoldingsDiff(h_old, h_new)))
+
+    print(f"rows per file        : {args.rows}")
+    print(f"changes / holdings   : {len(vector['changes'])} / {len(vector['holdings'])}")
+    print(f"legacy merge_frames  : {t_merge * 1000:8.1f} ms")
+    print(f"legacy build_rows    : {t_legacy * 1000:8.1f} ms")
+    print(f"HoldingsDiff         : {t_diff * 1000:8.1f} ms")
+    print(f"build_rows           : {t_vector * 1000:8.1f} ms")
+    print(f"speedup              : {(t_merge + t_legacy) / (t_diff + t_vector):8.1f}x")
+    print(f"retained legacy      : {legacy_kb:8.0f} KiB (merged frame + row dicts)")
+    print(f"retained compact     : {compact_kb:8.0f} KiB (diff arrays + slotted rows)")
+
+
+if __name__ == "__main__":
+    main()
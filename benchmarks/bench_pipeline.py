@@ -0,0 +1,224 @@
+"""Offline end-to-end benchmarks for ETFProcessor against the local stand-in upstreams.
+
+Every scenario (number of ETFs x holdings per file) runs in its own process
+with fresh caches. The backend is pointed at benchmarks/standin_server.py,
+running in a separate process, through the *_BASE_URL settings. yfinance is
+replaced by the stand-in's canned responses. Each scenario times list_folder_files, compare_files,
+get_stock_price and get_real_data, cold and warm, and reports throughput
+and memory:
+
+    python benchmarks/bench_pipeline.py                       # quick grid
+    python benchmarks/bench_pipeline.py --etfs 4,50,200 --holdings 50,500,5000
+    python benchmarks/bench_pipeline.py --json results.json   # keep for comparing runs
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(HERE)
+sys.path.insert(0, HERE)
+from standin_server import CannedTicker, canned_yf_download  # noqa: E402
+
+
+def rss_mb():
+    """Current resident set size, when the platform exposes it."""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 2**20
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm") as fh:
+            return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 1024
+
+
+def timed(fn, repeat=1):
+    """Best wall time of repeat calls, and the last result."""
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def start_standin(n_holdings, workdir):
+    """Starts standin_server.py in its own process and returns (process, environment for the backend)."""
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, "standin_server.py"), "--port", "0",
+         "--holdings", str(n_holdings), "--workdir", workdir],
+        stdout=subprocess.PIPE, text=True,
+    )
+    env = {}
+    for _ in range(4):
+        name, _, value = proc.stdout.readline().strip().partition("=")
+        env[name] = value
+    return proc, env
+
+
+def run_scenario(n_etfs, n_holdings, repeat):
+    workdir = tempfile.mkdtemp(prefix=f"etf-bench-{n_etfs}x{n_holdings}-")
+    server, env = start_standin(n_holdings, os.path.join(workdir, "upstream"))
+    os.environ.update(env)
+    base_url = env["DRIVE_BASE_URL"]
+
+    sys.path.insert(0, REPO_ROOT)
+    import backend.main as backend
+    backend.yf.download = canned_yf_download
+    backend.yf.Ticker = CannedTicker
+
+    # Have the stand-in generate every workbook up front, outside the timings
+    folders = {f"B{i:03d}": f"{base_url}/drive/folders/BENCH{i:03d}" for i in range(n_etfs)}
+    print(f"[{n_etfs}x{n_holdings}] generating workbooks...", file=sys.stderr)
+    with httpx.Client(base_url=base_url, timeout=600) as client:
+        for url in folders.values():
+            page = client.get("/embeddedfolderview", params={"id": url.rsplit("/", 1)[1]}).text
+            for fid in re.findall(r"/file/d/([^/]+)/", page):
+                client.get("/download", params={"id": fid})
+    upstream_requests = lambda: httpx.get(f"{base_url}/_standin/requests", params={"reset": 1}).json()  # noqa: E731
+
+    runs = iter(range(1_000))
+
+    def fresh_processor():
+        # CACHE_DIR is relative, so a new working directory means empty caches
+        run_dir = os.path.join(workdir, f"run{next(runs)}")
+        os.makedirs(run_dir)
+        os.chdir(run_dir)
+        processor = backend.ETFProcessor()
+        processor.file_map = dict(folders)
+        return processor
+
+    result = {"etfs": n_etfs, "holdings": n_holdings}
+    rss_start = rss_mb()
+
+    # Folder listing: cold (no manifests) and warm (ETag revalidation)
+    processor = fresh_processor()
+    list_all = lambda: [processor.list_folder_files(url) for url in folders.values()]  # noqa: E731
+    cold, listed = timed(list_all)
+    warm, _ = timed(list_all, repeat)
+    result["list"] = {"cold_s": cold, "warm_s": warm, "folders_per_s_cold": n_etfs / cold,
+                      "folders_per_s_warm": n_etfs / warm}
+
+    # One ETF comparison: parse + merge + prices, then again from the parsed and price caches
+    latest, previous = processor.find_latest_two_files(listed[0])
+    path_latest, path_old = processor.download_file(latest), processor.download_file(previous)
+    compare = lambda: processor.compare_files(path_old, path_latest, latest["date"])  # noqa: E731
+    cold, compared = timed(compare)
+    warm, _ = timed(compare, repeat)
+    assert "data" in compared, compared
+    result["compare"] = {"cold_s": cold, "warm_s": warm, "rows_per_s_cold": 2 * n_holdings / cold,
+                         "changes": len(compared["data"]["changes"])}
+
+    # Single-symbol price lookups, through MIS for today and STOCK_DAY for a past day
+    processor = fresh_processor()
+    codes = [str(1101 + i) for i in range(min(n_holdings, 100))]
+    today = time.strftime("%Y%m%d")
+    for label, date_str in (("today", today), ("history", latest["date"])):
+        lookup = lambda: [processor.get_stock_price(c, date_str) for c in codes]  # noqa: E731
+        cold, prices = timed(lookup)
+        warm, _ = timed(lookup, repeat)
+        result[f"price_{label}"] = {"cold_ms_per_call": 1000 * cold / len(codes),
+                                    "warm_ms_per_call": 1000 * warm / len(codes),
+                                    "resolved": sum(1 for p in prices if p)}
+
+    # Full pipeline for every ETF, cold and with nothing new upstream
+    processor = fresh_processor()
+    upstream_requests()
+    cold, (data, _) = timed(processor.get_real_data)
+    upstream = upstream_requests()
+    rss_after = rss_mb()
+    warm, _ = timed(processor.get_real_data, repeat)
+    rows = sum(len(v["changes"]) for v in data.values() if v)
+    result["real_data"] = {
+        "cold_s": cold, "warm_s": warm,
+        "etfs_per_s_cold": n_etfs / cold,
+        "holdings_rows_per_s_cold": 2 * n_etfs * n_holdings / cold,
+        "change_rows": rows,
+        "upstream_requests_cold": upstream,
+    }
+    result["memory"] = {"rss_start_mb": rss_start, "rss_after_cold_mb": rss_after, "peak_rss_mb": peak_rss_mb()}
+
+    server.terminate()
+    server.wait()
+    return result
+
+
+def fmt(value, spec):
+    return "n/a" if value is None else format(value, spec)
+
+
+def print_table(results):
+    header = (f"{'scenario':>10} | {'list cold/warm f/s':>19} | {'compare cold/warm s':>19} | "
+              f"{'price ms today/hist':>19} | {'e2e cold/warm s':>17} | {'rows/s':>9} | {'peak MB':>7}")
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        if "error" in r:
+            print(f"{r['etfs']:>4}x{r['holdings']:<5} | failed: {r['error']}")
+            continue
+        print(f"{r['etfs']:>4}x{r['holdings']:<5} | "
+              f"{r['list']['folders_per_s_cold']:>8.1f} /{r['list']['folders_per_s_warm']:>8.1f} | "
+              f"{r['compare']['cold_s']:>8.3f} /{r['compare']['warm_s']:>8.3f} | "
+              f"{r['price_today']['cold_ms_per_call']:>8.2f} /{r['price_history']['cold_ms_per_call']:>8.2f} | "
+              f"{r['real_data']['cold_s']:>7.2f} /{r['real_data']['warm_s']:>7.2f} | "
+              f"{r['real_data']['holdings_rows_per_s_cold']:>9.0f} | {fmt(r['memory']['peak_rss_mb'], '>7.0f')}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--etfs", default="4,20", help="comma-separated ETF counts (4 to 200)")
+    parser.add_argument("--holdings", default="50,500", help="comma-separated holdings per file (50 to 5000)")
+    parser.add_argument("--repeat", type=int, default=3, help="warm runs per measurement, best is kept")
+    parser.add_argument("--json", help="also write the raw results to this file")
+    parser.add_argument("--verbose", action="store_true", help="show the backend's log output")
+    parser.add_argument("--scenario", help=argparse.SUPPRESS)  # ETFSxHOLDINGS, run in this process
+    args = parser.parse_args()
+
+    if args.scenario:
+        n_etfs, n_holdings = map(int, args.scenario.split("x"))
+        out = sys.stdout
+        sys.stdout = sys.stderr  # backend progress lines stay out of the JSON result
+        out.write(json.dumps(run_scenario(n_etfs, n_holdings, args.repeat)) + "\n")
+        return
+
+    results = []
+    for n_etfs in map(int, args.etfs.split(",")):
+        for n_holdings in map(int, args.holdings.split(",")):
+            proc = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--scenario", f"{n_etfs}x{n_holdings}",
+                 "--repeat", str(args.repeat)],
+                stdout=subprocess.PIPE, stderr=None if args.verbose else subprocess.DEVNULL, text=True,
+            )
+            lines = proc.stdout.strip().splitlines()
+            if proc.returncode or not lines:
+                results.append({"etfs": n_etfs, "holdings": n_holdings, "error": f"exit code {proc.returncode}"})
+            else:
+                results.append(json.loads(lines[-1]))
+
+    print_table(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fh:
+            json.dump(results, fh, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,326 @@
+"""Local stand-in for Google Drive, TWSE MIS, TWSE STOCK_DAY and Yahoo Finance.
+
+Serves the recorded responses in benchmarks/fixtures, scaled up to any number
+of ETF folders and holdings, so ETFProcessor can be benchmarked offline:
+
+    python benchmarks/standin_server.py --port 8765 --holdings 500   # --port 0 picks a free port
+    DRIVE_BASE_URL=http://127.0.0.1:8765 DRIVE_DOWNLOAD_BASE_URL=http://127.0.0.1:8765 \
+    MIS_BASE_URL=http://127.0.0.1:8765 TWSE_BASE_URL=http://127.0.0.1:8765 python start.py
+
+Any folder id gets a folder of dated holdings workbooks, generated on first
+request in one of the recorded 00980A / 00982A layouts. Prices are a
+deterministic function of the ticker, so every run sees the same data.
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import zlib
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+import numpy as np
+import pandas as pd
+from openpyxl import Workbook
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+LAYOUTS = ["00980A", "00982A"]
+FIRST_DATE = datetime(2026, 1, 2)
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES, name), encoding="utf-8") as fh:
+        return fh.read()
+
+
+def price_for(code):
+    """Close price served for a ticker, the same on every source and every run."""
+    return round(10 + (zlib.crc32(code.encode()) % 99_000) / 100, 2)
+
+
+def has_twse_data(code):
+    # One ticker in ten is "not listed on TWSE", so lookups fall through to Yahoo
+    return int(code) % 10 != 7
+
+
+def trading_days(n):
+    days, d = [], FIRST_DATE
+    while len(days) < n:
+        if d.weekday() < 5:
+            days.append(d)
+        d += timedelta(days=1)
+    return days
+
+
+class StandIn:
+    """Folder listings, workbooks and quotes for the stand-in server."""
+
+    def __init__(self, holdings=500, files_per_folder=2, workdir=None):
+        self.holdings = holdings
+        self.files_per_folder = files_per_folder
+        self.workdir = workdir or tempfile.mkdtemp(prefix="etf-standin-")
+        os.makedirs(self.workdir, exist_ok=True)
+        self.requests = {}  # route -> count
+        self._lock = threading.Lock()
+        self._folders = {}  # folder id -> [(name, file id)]
+        self._files = {}  # file id -> (folder index, day index, layout, date)
+        self._universe = [str(1101 + i) for i in range(max(2 * holdings, 100))]
+
+        page = load_fixture("drive_embedded_folder.html")
+        entry = re.search(r'<div class="flip-entry" id="entry-(?P<id>[^"]+)".*?'
+                          r'<div class="flip-entry-last-modified"><div>[^<]*</div></div></div>', page)
+        self._page_head, self._page_tail = page[:entry.start()], page[entry.end():]
+        self._entry = entry.group(0)
+        self._entry_id = entry.group("id")
+        self._entry_title = re.search(r'<div class="flip-entry-title">([^<]+)</div>', self._entry).group(1)
+        self._mis = json.loads(load_fixture("mis_getStockInfo.json"))
+        self._stock_day = json.loads(load_fixture("twse_stock_day.json"))
+        self._stock_day_nodata = load_fixture("twse_stock_day_nodata.json").encode()
+        with open(os.path.join(FIXTURES, "holdings_layouts.json"), encoding="utf-8") as fh:
+            self._layouts = json.load(fh)
+
+    def count(self, route):
+        with self._lock:
+            self.requests[route] = self.requests.get(route, 0) + 1
+
+    # ---------------- Drive ----------------
+    def folder(self, folder_id):
+        with self._lock:
+            if folder_id not in self._folders:
+                index = len(self._folders)
+                layout = LAYOUTS[index % len(LAYOUTS)]
+                label = f"F{index:03d}"
+                files = []
+                for day, d in enumerate(trading_days(self.files_per_folder)):
+                    fid = hashlib.sha1(f"{folder_id}/{day}".encode()).hexdigest()[:33]
+                    name = f"{label}-{d:%Y-%m-%d}.xlsx"
+                    files.append((name, fid))
+                    self._files[fid] = (index, day, layout, d)
+                self._folders[folder_id] = files
+            return self._folders[folder_id]
+
+    def folder_page(self, folder_id):
+        entries = "".join(
+            self._entry.replace(self._entry_id, fid).replace(self._entry_title, name)
+            for name, fid in self.folder(folder_id)
+        )
+        return (self._page_head + entries + self._page_tail).encode()
+
+    def workbook_path(self, fid):
+        """Generates the workbook for a file id on first use and returns its path."""
+        if fid not in self._files:
+            return None
+        path = os.path.join(self.workdir, f"{fid}.xlsx")
+        if not os.path.exists(path):
+            index, day, layout, date = self._files[fid]
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            self.write_workbook(tmp_path, self.holdings_frame(index, day), self._layouts[layout], date)
+            os.replace(tmp_path, path)
+        return path
+
+    def holdings_frame(self, index, day):
+        """Holdings of one fund on one day; each day replaces ~5% of names and trades ~30% of the rest."""
+        rng = np.random.default_rng(index)
+        codes = rng.choice(self._universe, size=self.holdings, replace=False)
+        shares = rng.integers(1, 5_000, size=self.holdings) * 1000
+        for d in range(day):
+            rng = np.random.default_rng((index, d))
+            swap = rng.random(self.holdings) < 0.05
+            codes = np.where(swap, rng.choice(self._universe, size=self.holdings), codes)
+            trade = rng.random(self.holdings) < 0.3
+            shares = np.where(trade, rng.integers(1, 5_000, size=self.holdings) * 1000, shares)
+        frame = pd.DataFrame({"code": codes, "shares": shares}).drop_duplicates("code")
+        frame["weight"] = frame["shares"] / frame["shares"].sum() * 100
+        return frame
+
+    def write_workbook(self, path, frame, layout, date):
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet(layout["sheet"])
+        for row in layout["preamble"]:
+            ws.append([cell.replace("{date}", f"{date:%Y/%m/%d}") for cell in row])
+        ws.append(layout["columns"])
+        for code, shares, weight in zip(frame["code"], frame["shares"], frame["weight"]):
+            values = {
+                "股票代號": code,
+                "股票名稱": f"股票{code}",
+                "股數": layout["shares"].format(int(shares)) if layout["shares"] else int(shares),
+                "持股權重(%)": layout["weight"].format(weight) if layout["weight"] else round(weight, 2),
+            }
+            ws.append([values[c] for c in layout["columns"]])
+        wb.save(path)
+
+    # ---------------- Quotes ----------------
+    def mis(self, channels):
+        template = self._mis["msgArray"][0]
+        items = []
+        for channel in channels:
+            ex, _, symbol = channel.partition("_")
+            code = symbol.split(".")[0]
+            # Every ticker is "listed" on exactly one exchange
+            if ex != ("otc" if int(code) % 5 == 0 else "tse"):
+                continue
+            close = price_for(code)
+            items.append({**template, "c": code, "ch": symbol, "ex": ex, "n": f"股票{code}",
+                          "z": f"{close:.4f}", "y": f"{close * 0.99:.4f}", "d": datetime.now().strftime("%Y%m%d")})
+        return json.dumps({**self._mis, "msgArray": items}, ensure_ascii=False).encode()
+
+    def stock_day(self, code, month):
+        if not has_twse_data(code):
+            return self._stock_day_nodata
+        start = datetime.strptime(month[:6], "%Y%m")
+        close = f"{price_for(code):,.2f}"
+        rows = []
+        template = self._stock_day["data"][0]
+        d = start
+        while d.month == start.month:
+            if d.weekday() < 5:
+                rows.append([f"{d.year - 1911}/{d:%m/%d}", *template[1:6], close, *template[7:]])
+            d += timedelta(days=1)
+        title = re.sub(r"\d+年\d+月 \d+", f"{start.year - 1911}年{start:%m}月 {code}", self._stock_day["title"])
+        return json.dumps({**self._stock_day, "date": f"{month[:6]}01", "title": title,
+                           "data": rows, "total": len(rows)}, ensure_ascii=False).encode()
+
+
+def canned_yf_download(tickers, start=None, end=None, **kwargs):
+    """Replacement for yfinance.download: one Close row per requested day, .TW symbols only."""
+    if isinstance(tickers, str):
+        tickers = [tickers]
+    day = pd.Timestamp(start)
+    close = {t: [price_for(t.split(".")[0]) if t.endswith(".TW") else np.nan] for t in tickers}
+    frame = pd.DataFrame(close, index=pd.DatetimeIndex([day], name="Date"))
+    frame.columns = pd.MultiIndex.from_product([["Close"], frame.columns])
+    return frame
+
+
+class CannedTicker:
+    """Replacement for yfinance.Ticker; only fast_info.last_price is used by the backend."""
+
+    def __init__(self, symbol):
+        last_price = price_for(symbol.split(".")[0]) if symbol.endswith(".TW") else None
+        self.fast_info = {"lastPrice": last_price, "last_price": last_price}
+
+
+def make_handler(standin):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Headers and body go out in separate writes; without this Nagle adds ~40 ms per response
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def send_body(self, body, content_type, status=200, headers=None):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            route = url.path.rstrip("/")
+            if route.startswith("/drive/folders/"):
+                route = "/drive/folders"
+            if route == "/_standin/requests":
+                # Request counts per route, for benchmarks running the server in another process
+                body = json.dumps(standin.requests).encode()
+                if "reset" in query:
+                    standin.requests.clear()
+                self.send_body(body, "application/json")
+                return
+            standin.count(route)
+
+            if route == "/embeddedfolderview":
+                body = standin.folder_page(query["id"][0])
+                etag = f'"{hashlib.sha1(body).hexdigest()}"'
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self.send_body(body, "text/html; charset=utf-8", headers={"ETag": etag})
+            elif route == "/drive/folders":
+                folder_id = url.path.rstrip("/").rsplit("/", 1)[1]
+                self.send_body(standin.folder_page(folder_id), "text/html; charset=utf-8")
+            elif route == "/download":
+                path = standin.workbook_path(query["id"][0])
+                if path is None:
+                    self.send_body(b"<html>Not found</html>", "text/html", status=404)
+                    return
+                with open(path, "rb") as fh:
+                    body = fh.read()
+                content_type = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+                ranged = re.match(r"bytes=(\d+)-$", self.headers.get("Range", ""))
+                if ranged:
+                    start = int(ranged.group(1))
+                    if start >= len(body):
+                        self.send_body(b"", content_type, status=416)
+                        return
+                    self.send_body(body[start:], content_type, status=206,
+                                   headers={"Content-Range": f"bytes {start}-{len(body) - 1}/{len(body)}"})
+                else:
+                    self.send_body(body, content_type)
+            elif route == "/stock/api/getStockInfo.jsp":
+                channels = unquote(query.get("ex_ch", [""])[0]).split("|")
+                self.send_body(standin.mis(channels), "application/json; charset=utf-8")
+            elif route == "/exchangeReport/STOCK_DAY":
+                body = standin.stock_day(query["stockNo"][0], query["date"][0])
+                self.send_body(body, "application/json; charset=utf-8")
+            else:
+                self.send_body(b"Not found", "text/plain", status=404)
+
+    return Handler
+
+
+class StandInServer:
+    """Runs a StandIn on a background thread; base_url works for every *_BASE_URL setting."""
+
+    def __init__(self, standin, port=0):
+        self.standin = standin
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), make_handler(standin))
+        self.httpd.daemon_threads = True
+        self.base_url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def env(self):
+        return {name: self.base_url for name in
+                ("DRIVE_BASE_URL", "DRIVE_DOWNLOAD_BASE_URL", "MIS_BASE_URL", "TWSE_BASE_URL")}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--holdings", type=int, default=500)
+    parser.add_argument("--files-per-folder", type=int, default=2)
+    parser.add_argument("--workdir", help="where generated workbooks are kept (default: a temp dir)")
+    args = parser.parse_args()
+
+    server = StandInServer(StandIn(args.holdings, args.files_per_folder, args.workdir), args.port)
+    for name, value in server.env().items():
+        print(f"{name}={value}", flush=True)
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,18 @@ import { TrendingUp, TrendingDown, Layers, Activity, Calendar, DollarSign } from
 
 const API_BASE = 'http://localhost:8000/api';
 
+// Only the columns the tables render are requested from the backend
+const CHANGE_FIELDS = 'ticker,name,old_shares,new_shares,delta_shares,price,monetary_value,monetary_value_str,action';
+const HOLDING_FIELDS = 'ticker,name,new_shares,monetary_value,monetary_value_str';
+const HOLDINGS_PAGE_SIZE = 5000;
+
+const PENDING_SUMMARY = {
+  total_buy_str: '…',
+  total_sell_str: '…',
+  count_added: '…',
+  count_removed: '…'
+};
+
 const formatCurrency = (val) => {
   return new Intl.NumberFormat('zh-TW', {
     style: 'currency',
@@ -17,34 +29,105 @@ const formatNumber = (val) => {
   return new Intl.NumberFormat('zh-TW').format(val);
 };
 
-const formatLargeNumber = (val) => {
-  if (val === undefined || val === null || isNaN(val)) return "—";
-  const absn = Math.abs(val);
-  const sign = val < 0 ? "-" : "";
-  if (absn >= 100_000_000) {
-    return `${sign}${(absn / 100_000_000).toFixed(1)}億`;
-  } else if (absn >= 10_000) {
-    return `${sign}${Math.round(absn / 10_000)}萬`;
-  } else {
-    return `${sign}${Math.round(absn)}`;
-  }
-};
-
 function App() {
   const [data, setData] = useState(null);
   const [loading, setLoading] = useState(true);
   const [activeTab, setActiveTab] = useState('aggregated');
   const [sortConfig, setSortConfig] = useState({ key: 'monetary_value', direction: 'desc' });
+  const [aggregateRows, setAggregateRows] = useState([]);
+  const [aggregateError, setAggregateError] = useState(null);
 
   useEffect(() => {
     fetchData();
   }, []);
 
+  // Cross-ETF flows are aggregated and sorted by the backend, once the whole snapshot is in
+  useEffect(() => {
+    if (data?.built_at && activeTab === 'aggregated') {
+      fetchAggregate(sortConfig);
+    }
+  }, [data?.built_at, activeTab, sortConfig]);
+
+  // Full holdings are only loaded when an ETF tab is opened
+  useEffect(() => {
+    const etfData = data?.etf_details[activeTab];
+    if (data?.built_at && etfData && !etfData.holdings) {
+      fetchHoldings(activeTab);
+    }
+  }, [data?.built_at, activeTab]);
+
+  const fetchAggregate = async ({ key, direction }) => {
+    try {
+      const res = await axios.get(`${API_BASE}/holdings/aggregate`, {
+        params: { sort: key, order: direction }
+      });
+      // The backend reports failures as { error } with a 200 status
+      if (res.data.error) throw new Error(res.data.error);
+      setAggregateRows(res.data.rows || []);
+      setAggregateError(null);
+    } catch (err) {
+      console.error("Failed to fetch aggregated flows", err);
+      setAggregateError(err.message);
+    }
+  };
+
+  const fetchHoldings = async (etf) => {
+    try {
+      const res = await axios.get(`${API_BASE}/holdings/etf/${etf}`, {
+        params: { kind: 'holdings', fields: HOLDING_FIELDS, limit: HOLDINGS_PAGE_SIZE }
+      });
+      const rows = res.data.rows || [];
+      setData(prev => ({
+        ...prev,
+        etf_details: { ...prev.etf_details, [etf]: { ...prev.etf_details[etf], holdings: rows } }
+      }));
+    } catch (err) {
+      console.error(`Failed to fetch holdings for ${etf}`, err);
+    }
+  };
+
+  // Each NDJSON line is one ETF's changes, rendered as soon as it arrives; the summary comes last
+  const handleStreamLine = (line) => {
+    const msg = JSON.parse(line);
+    if (msg.type === 'etf') {
+      setData(prev => ({
+        dates: prev?.dates ?? msg.dates ?? {},
+        summary: prev?.summary ?? PENDING_SUMMARY,
+        etf_details: { ...prev?.etf_details, [msg.etf]: { changes: msg.changes || [] } }
+      }));
+    } else if (msg.type === 'summary') {
+      setData(prev => ({
+        ...prev,
+        etf_details: prev?.etf_details ?? {},
+        dates: msg.dates,
+        summary: msg.summary,
+        built_at: msg.built_at
+      }));
+    } else if (msg.type === 'error') {
+      throw new Error(msg.error);
+    }
+    setLoading(false);
+  };
+
   const fetchData = async () => {
     try {
       setLoading(true);
-      const res = await axios.get(`${API_BASE}/holdings/changes`);
-      setData(res.data);
+      setData(null);
+      const params = new URLSearchParams({ kind: 'changes', fields: CHANGE_FIELDS });
+      const res = await fetch(`${API_BASE}/holdings/changes/stream?${params}`);
+      if (!res.ok) throw new Error(`HTTP ${res.status}`);
+
+      const reader = res.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      for (;;) {
+        const { done, value } = await reader.read();
+        buffer += decoder.decode(value || new Uint8Array(), { stream: !done });
+        const lines = buffer.split('\n');
+        buffer = lines.pop();
+        lines.filter(l => l.trim()).forEach(handleStreamLine);
+        if (done) break;
+      }
     } catch (err) {
       console.error("Failed to fetch data", err);
     } finally {
@@ -63,47 +146,14 @@ function App() {
   const getSortedData = (type = 'changes') => {
     if (!data) return [];
 
-    let items = [];
     if (activeTab === 'aggregated') {
-      if (type === 'changes') {
-        const merged = {};
-        Object.entries(data.etf_details).forEach(([etfCode, details]) => {
-          if (details.changes) {
-            details.changes.forEach(change => {
-              const ticker = change.ticker;
-              if (!merged[ticker]) {
-                merged[ticker] = {
-                  ...change,
-                  affected_etfs: [etfCode],
-                  // Ensure numeric types for accumulation
-                  delta_shares: Number(change.delta_shares),
-                  monetary_value: Number(change.monetary_value),
-                  old_shares: Number(change.old_shares),
-                  new_shares: Number(change.new_shares)
-                };
-              } else {
-                merged[ticker].affected_etfs.push(etfCode);
-                merged[ticker].delta_shares += Number(change.delta_shares);
-                merged[ticker].monetary_value += Number(change.monetary_value);
-                merged[ticker].old_shares += Number(change.old_shares);
-                merged[ticker].new_shares += Number(change.new_shares);
-              }
-            });
-          }
-        });
-
-        items = Object.values(merged)
-          .filter(item => item.delta_shares !== 0) // Filter out items with no net change
-          .map(item => ({
-            ...item,
-            monetary_value_str: formatLargeNumber(item.monetary_value)
-          }));
-      }
-    } else {
-      const etfData = data.etf_details[activeTab];
-      if (etfData && etfData[type]) {
-        items = [...etfData[type]];
-      }
+      return type === 'changes' ? aggregateRows : [];
+    }
+
+    let items = [];
+    const etfData = data.etf_details[activeTab];
+    if (etfData && etfData[type]) {
+      items = [...etfData[type]];
     }
 
     // Sort logic
@@ -224,6 +274,15 @@ function App() {
                 {activeTab === 'aggregated' ? '全 ETF 整合異動' : `${activeTab} 詳細異動`}
               </h2>
 
+              {activeTab === 'aggregated' && aggregateError && (
+                <div className="mb-6 text-red-400">
+                  無法載入整合異動: {aggregateError}
+                  <button onClick={() => fetchAggregate(sortConfig)} className="ml-4 underline hover:text-red-300">
+                    重試
+                  </button>
+                </div>
+              )}
+
               <table>
                 <thead>
                   <tr>
@@ -324,7 +383,7 @@ function App() {
             )}
 
             {activeTab !== 'aggregated' &&
-              (!data.etf_details[activeTab].changes || data.etf_details[activeTab].changes.length === 0) && (
+              (!data.etf_details[activeTab]?.changes || data.etf_details[activeTab].changes.length === 0) && (
                 <div className="py-20 text-center text-gray-500 italic">
                   此日期區間無異動資料
                 </div>